@@ -0,0 +1,201 @@
+import collections
+import concurrent.futures
+import threading
+import time
+import firmware
+import metrics
+
+# Seconds the backend is given to acknowledge one attempt of a command
+COMMAND_TIMEOUT_SECONDS = 2.0
+COMMAND_ATTEMPTS = 3
+# Doubled after each failed attempt
+RETRY_BACKOFF_SECONDS = 0.25
+# Issue to acknowledgement latencies kept for get_stats
+LATENCY_SAMPLES = 1024
+
+FIRMWARE_CALL_SECONDS = metrics.REGISTRY.histogram("poolfilter_firmware_call_seconds",
+                                                   "Duration of each attempt to send a speed to the firmware",
+                                                   ("outcome", ))
+
+
+class Actuator():
+    '''
+    Sends speed commands to the firmware from a worker thread per controller, so callers holding the scheduler lock
+    never wait on pump I/O and one unresponsive controller does not hold up the rest
+    At most one command per controller waits to be sent, a newer command replaces one that has not been sent yet
+    Each attempt is given timeout seconds whether or not the backend honours it, a failed attempt is retried after a backoff
+    '''
+
+    def __init__(self, backend=firmware, timeout=COMMAND_TIMEOUT_SECONDS, attempts=COMMAND_ATTEMPTS):
+        self._backend = backend
+        self._timeout = timeout
+        self._attempts = attempts
+
+        # Guards every controller's queue and the counts, each controller's worker waits on its own condition of it
+        self._lock = threading.Lock()
+        # controller id -> Actuator.Controller, created with its worker on the first command
+        self._controllers = {}
+
+        self._latencies_ms = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._sent_count = 0
+        self._coalesced_count = 0
+        self._retry_count = 0
+        self._failed_count = 0
+
+
+    def set_speed(self, speed, controller_id):
+        '''
+        Queues the speed for controller_id and returns immediately
+        '''
+        with self._lock:
+            controller = self._controllers.get(controller_id)
+            if controller is None:
+                controller = self._controllers[controller_id] = Actuator.Controller(self._lock)
+                threading.Thread(target=self._run, args=(controller, ), daemon=True).start()
+
+            if controller.pending is not None:
+                self._coalesced_count += 1
+            controller.pending = Actuator.Command(speed, controller_id, time.perf_counter())
+            # A retry of an older speed for this controller is superseded
+            controller.retry = None
+            controller.condition.notify()
+
+
+    def _run(self, controller):
+        while True:
+            with self._lock:
+                command = self._next_command(controller)
+
+            self._send(controller, command)
+
+
+    def _next_command(self, controller):
+        '''
+        [REQUIRES LOCK]
+        Waits for a new command for the controller or its retry coming due, a new command goes first
+        '''
+        while True:
+            if controller.pending is not None:
+                command = controller.pending
+                controller.pending = None
+                return command
+
+            if controller.retry is None:
+                controller.condition.wait()
+                continue
+
+            retry_at, command = controller.retry
+            delay = retry_at - time.perf_counter()
+            if delay > 0:
+                controller.condition.wait(delay)
+                continue
+
+            controller.retry = None
+            self._retry_count += 1
+            return command
+
+
+    def _send(self, controller, command):
+        command.attempts += 1
+        start = time.perf_counter()
+
+        try:
+            self._call_backend(controller, command)
+        except Exception as e:
+            FIRMWARE_CALL_SECONDS.observe(time.perf_counter() - start, "error")
+            print("Controller %d speed %d attempt %d failed: %s" % (command.controller_id, command.speed, command.attempts, str(e)))
+        else:
+            FIRMWARE_CALL_SECONDS.observe(time.perf_counter() - start, "ok")
+            latency_ms = (time.perf_counter() - command.issued) * 1000
+            with self._lock:
+                self._sent_count += 1
+                self._latencies_ms.append(latency_ms)
+            return
+
+        with self._lock:
+            # A newer command for this controller is queued, retrying the old speed would only delay it
+            if controller.pending is not None:
+                return
+
+            if command.attempts < self._attempts:
+                retry_at = time.perf_counter() + RETRY_BACKOFF_SECONDS * 2 ** (command.attempts - 1)
+                controller.retry = (retry_at, command)
+                return
+
+            self._failed_count += 1
+
+        print("Controller %d speed %d failed after %d attempts" % (command.controller_id, command.speed, command.attempts))
+
+
+    def _call_backend(self, controller, command):
+        '''
+        Runs the backend call on its own thread and waits at most timeout for it, raising TimeoutError past that
+        A call that overran keeps running, the next attempt first gives it another timeout to return rather than
+        piling a second call onto a controller that has not answered
+        '''
+        if controller.call is not None:
+            done, _ = concurrent.futures.wait([controller.call], self._timeout)
+            if not done:
+                raise TimeoutError("Controller %d has not answered an earlier command within %.3f s"
+                                   % (command.controller_id, self._timeout))
+
+        call = controller.call = concurrent.futures.Future()
+
+        def run_call():
+            try:
+                call.set_result(self._backend.set_speed(command.speed, command.controller_id, timeout=self._timeout))
+            except Exception as e:
+                call.set_exception(e)
+
+        threading.Thread(target=run_call, daemon=True).start()
+
+        try:
+            call.result(self._timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError("Controller %d did not acknowledge speed %d within %.3f s"
+                               % (command.controller_id, command.speed, self._timeout))
+
+
+    def get_stats(self):
+        '''
+        Returns command counts and issue to acknowledgement latencies in milliseconds
+        '''
+        with self._lock:
+            last_ms = self._latencies_ms[-1] if self._latencies_ms else None
+            latencies = sorted(self._latencies_ms)
+            stats = {
+                "sent": self._sent_count,
+                "coalesced": self._coalesced_count,
+                "retries": self._retry_count,
+                "failed": self._failed_count,
+                "queued": sum(controller.pending is not None for controller in self._controllers.values()),
+                "retrying": sum(controller.retry is not None for controller in self._controllers.values())
+            }
+
+        if latencies:
+            stats["last_ms"] = last_ms
+            stats["mean_ms"] = sum(latencies) / len(latencies)
+            stats["p99_ms"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            stats["max_ms"] = latencies[-1]
+
+        return stats
+
+
+    class Command():
+        def __init__(self, speed, controller_id, issued):
+            self.speed = speed
+            self.controller_id = controller_id
+            # perf_counter() when the command was queued
+            self.issued = issued
+            self.attempts = 0
+
+
+    class Controller():
+        def __init__(self, lock):
+            self.condition = threading.Condition(lock)
+            # Actuator.Command not sent yet
+            self.pending = None
+            # (perf_counter() to retry at, Actuator.Command) after a failed attempt
+            self.retry = None
+            # concurrent.futures.Future of the last backend call
+            self.call = None
@@ -1,16 +1,47 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context, url_for
 from flask_cors import CORS
-from database import Database
+from database import Database, ProgramBatchError, ProgramOverlapError
 from scheduler import Scheduler
+from actuator import Actuator
+from broadcast import Broadcaster
+from checkpoint import StateCheckpoint
+from history import RunHistory
+from leader import FollowerScheduler, LeaderCallError, LeaderElection, LeaderUnavailableError
+from telemetry import MAX_QUERY_POINTS, Telemetry, parse_samples
+from models import API_FIELDS, Program, parse_id, parse_month_day, parse_speed, parse_time
+import firmware
+import metrics
 import time
 from datetime import datetime, timedelta
 import os
 import consts
+import base64
+import json
 import sqlite3
 
 
+# A Scheduler in the worker leading the scheduler, a FollowerScheduler forwarding to it in the others
 scheduler = None
 database = None
+# Every worker buffers the telemetry it is sent
+telemetry = None
+
+# Seconds between comments on an idle stream, keeps proxies from timing it out and finds clients that have gone
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Largest limit a /program/all page may ask for
+MAX_PAGE_SIZE = 1000
+# Longest range a /schedule request may cover
+MAX_SCHEDULE_DAYS = 3 * 366
+# Last year to may fall in, durations are interpolated against the following year's seasons
+# and the next event may be looked up in the year after to
+MAX_SCHEDULE_YEAR = datetime.max.year - 2
+# Items serialized per chunk of a streamed JSON list
+STREAM_CHUNK_ITEMS = 256
+
+REQUEST_SECONDS = metrics.REGISTRY.histogram("poolfilter_http_request_seconds",
+                                             "Time to build each response, streamed bodies are not included",
+                                             ("route", "method", "status"))
 
 
 def create_app():
@@ -20,47 +51,364 @@ def create_app():
     if app.config["ENV"] == "production" or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
         global scheduler
         global database
+        global telemetry
 
         database = Database(app.config["ENV"])
-        scheduler = Scheduler(database)
+        telemetry = Telemetry(database)
+        election = LeaderElection(database.DB_PATH)
+
+        if election.try_lead():
+            scheduler = start_scheduler(election, Broadcaster())
+        else:
+            print("Following the scheduler leader on %s" % (election.address, ))
+            scheduler = FollowerScheduler(database, election)
+            election.follow(lambda: take_over(election))
 
     return app
 
 
+def start_scheduler(election, broadcaster):
+    '''
+    [REQUIRES LEADING]
+    '''
+    leader_scheduler = Scheduler(database, Actuator(get_firmware_backend()), RunHistory(database), StateCheckpoint(database), broadcaster=broadcaster)
+    election.serve(leader_scheduler)
+    return leader_scheduler
+
+
+def take_over(election):
+    '''
+    Called once the leader is gone and this worker holds the lock, replaces its FollowerScheduler
+    '''
+    global scheduler
+
+    follower = scheduler
+    follower.stop()
+    # Streams already open on this worker keep their subscriptions
+    scheduler = start_scheduler(election, follower.broadcaster)
+    print("Took over as the scheduler leader")
+
+
+def get_firmware_backend():
+    '''
+    SIMULATED_FIRMWARE_DELAY (seconds) swaps the pump for firmware.SimulatedFirmware when testing
+    '''
+    delay = os.environ.get("SIMULATED_FIRMWARE_DELAY")
+    if delay is None:
+        return firmware
+
+    return firmware.SimulatedFirmware(float(delay), float(os.environ.get("SIMULATED_FIRMWARE_FAILURE_RATE", 0)))
+
+
 app = create_app()
 cors = CORS(app, resources={r"/*": {"origins": "http://localhost:19006"}})
 
 
+@app.errorhandler(LeaderUnavailableError)
+def leader_unavailable(error):
+    return jsonify({"message": str(error)}), 503
+
+
+@app.errorhandler(LeaderCallError)
+def leader_call_failed(error):
+    # Followers commit before forwarding, only the leader's scheduler missed the change
+    message = "The change was stored but the scheduler leader failed to reschedule it: %s" % (str(error), )
+    return jsonify({"message": message}), 500
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    start = getattr(g, "request_start", None)
+    if start is not None:
+        # The rule rather than the path, so ids in the url do not each get their own series
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route, request.method, response.status_code)
+    return response
+
+
 @app.route('/')
 def index():
     return '''<h1>Welcome to Kyle Brainard\'s Pool Filter API</h1>
               <p>Documentation coming soon. Autogenerate doxygen?</p>'''
 
 
+def get_pool_id(args):
+    '''
+    Returns the pool named by the pool argument, the default pool if there is none, or None if it does not exist
+    '''
+    try:
+        pool_id = int(args.get(consts.POOL, consts.DEFAULT_POOL_ID))
+    except ValueError:
+        return None
+
+    if not database.has_pool(pool_id):
+        return None
+
+    return pool_id
+
+
+@app.route('/pool/all', methods = ['GET'])
+def get_all_pools():
+    return jsonify(database.get_all_pools())
+
+
+@app.route('/pool/add', methods = ['POST'])
+def post_new_pool():
+    controller_id = request.args.get(consts.CONTROLLER)
+
+    if controller_id is None:
+        return jsonify({"message": "Did not provide controller of pool to add"}), 400
+
+    try:
+        controller_id = parse_id(controller_id, "Controller")
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    pool_id = database.add_pool(controller_id)
+
+    with scheduler:
+        scheduler.add_pool(pool_id, controller_id)
+
+    return jsonify({"message": "Successfully added new pool", consts.ID: pool_id})
+
+
+@app.route('/pool/delete', methods = ['DELETE'])
+def delete_pool():
+    pool_id = request.args.get(consts.POOL)
+
+    if pool_id is None:
+        return jsonify({"message": "Did not provide pool to delete"}), 400
+
+    try:
+        pool_id = parse_id(pool_id, "Pool")
+    except ValueError:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    if not database.delete_pool(pool_id):
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    with scheduler:
+        scheduler.remove_pool(pool_id)
+    return jsonify({"message": "Sucessfully deleted pool"})
+
+
 @app.route('/program/now', methods = ['GET'])
 def get_current_program():
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
     try:
-        with scheduler:
-            return jsonify(scheduler.get_current_event())
+        return jsonify(scheduler.get_current_event(pool_id))
     except Exception as e:
         return jsonify({"message": str(e)}), 500
 
 
+@app.route('/program/stream', methods = ['GET'])
+def stream_current_program():
+    '''
+    Server-Sent Events stream of the /program/now payload, sent on connect and again whenever it changes
+    '''
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    subscription = scheduler.broadcaster.subscribe(pool_id)
+    if subscription is None:
+        return jsonify({"message": "Too many open streams"}), 503
+
+    # Subscribed first, so a change made while this is read is still sent
+    try:
+        state = scheduler.get_current_event(pool_id)
+    except BaseException:
+        # No response owns the subscription yet to close it, it would hold its slot for good
+        subscription.close()
+        raise
+
+    def generate():
+        last_sent = state
+        yield "data: %s\n\n" % (json.dumps(state), )
+
+        while True:
+            states = subscription.get(STREAM_KEEPALIVE_SECONDS)
+            if states is None:
+                # The pool was removed
+                return
+
+            if not states:
+                yield ": keep-alive\n\n"
+
+            for state_change in states:
+                if state_change != last_sent:
+                    last_sent = state_change
+                    yield "data: %s\n\n" % (json.dumps(state_change), )
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    # Also runs if the client leaves before the first byte, when the generator's own cleanup would not
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.route('/scheduler/jitter', methods = ['GET'])
+def get_scheduler_jitter():
+    return jsonify(scheduler.get_jitter())
+
+
+@app.route('/scheduler/reschedules', methods = ['GET'])
+def get_scheduler_reschedules():
+    return jsonify(scheduler.get_reschedule_stats())
+
+
+@app.route('/actuator/stats', methods = ['GET'])
+def get_actuator_stats():
+    return jsonify(scheduler.actuator.get_stats())
+
+
+@app.route('/metrics', methods = ['GET'])
+def get_metrics():
+    '''
+    Route, SQLite, scheduler lock, firmware and event lag histograms in the Prometheus text format
+    '''
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def conditional_get(build):
+    '''
+    Tags build()'s response with a strong ETag of the database's data version
+    Answers 304 without calling build() when If-None-Match already holds it, so an unchanged poll skips the query and serialization
+    '''
+    # Read before building, so the tag can never claim newer data than the body it is sent with
+    etag = "%s-%d" % (database.instance_token, database.data_version)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = app.make_response(build())
+        if response.status_code != 200:
+            return response
+
+    response.set_etag(etag)
+    # Clients may keep the body but must revalidate it on every poll
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 @app.route('/program/all', methods = ['GET'])
 def get_all_programs():
+    '''
+    Streams a JSON list of the pool's programs ordered by start
+    limit - return at most this many, up to MAX_PAGE_SIZE, the Link header names the next page unless this is the last
+    cursor - from a Link header, continues after the program its page ended on, programs added or removed since do not shift it
+    fields - comma separated keys of each program to return, all of them by default
+    '''
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    fields = request.args.get(consts.FIELDS)
+    if fields is not None:
+        fields = fields.split(",")
+        if not all(field in API_FIELDS for field in fields):
+            return jsonify({"message": "fields must be any of %s" % (", ".join(API_FIELDS), )}), 400
+
+    limit = request.args.get(consts.LIMIT)
     try:
-        return jsonify(database.get_all_programs())
-    except Exception as e:
-        return jsonify({"message": "SQLITE " + str(e)}), 500
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        limit = 0
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        return jsonify({"message": "limit must be a whole number from 1 to %d" % (MAX_PAGE_SIZE, )}), 400
+
+    cursor = request.args.get(consts.CURSOR)
+    try:
+        after = None if cursor is None else decode_cursor(pool_id, cursor)
+    except ValueError:
+        return jsonify({"message": "Passed cursor was not valid"}), 400
+
+    def build():
+        try:
+            # One extra tells whether there is a next page
+            programs = database.get_programs_page(pool_id, after, None if limit is None else limit + 1)
+        except Exception as e:
+            return jsonify({"message": "SQLITE " + str(e)}), 500
+
+        next_url = None
+        if limit is not None and len(programs) > limit:
+            programs = programs[:limit]
+            next_url = url_for("get_all_programs", pool=pool_id, limit=limit, cursor=encode_cursor(pool_id, programs[-1]),
+                               **({} if fields is None else {consts.FIELDS: ",".join(fields)}))
+
+        response = Response(stream_with_context(stream_json_list(program.to_dict(fields) for program in programs)), mimetype="application/json")
+        if next_url is not None:
+            response.headers["Link"] = '<%s>; rel="next"' % (next_url, )
+        return response
+
+    return conditional_get(build)
+
+
+def encode_cursor(pool_id, program):
+    '''
+    Opaque token of the (start, id) key a page ended on
+    '''
+    key = "%d:%d:%d" % (pool_id, program.start, program.id)
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def decode_cursor(pool_id, cursor):
+    '''
+    Returns the (start, id) key of a cursor made for the pool, raises ValueError for any other
+    '''
+    # Bad base64, bad UTF-8 and the wrong number of parts all raise ValueError or a subclass
+    key = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    cursor_pool_id, start, program_id = (int(part) for part in key.split(":"))
+
+    if cursor_pool_id != pool_id:
+        raise ValueError("Passed cursor was made for another pool")
+
+    return start, program_id
+
+
+def stream_json_list(items):
+    '''
+    Generator of a JSON list of items in chunks, the whole body is never held in memory
+    Keys are sorted as jsonify sorts them
+    '''
+    separator = "["
+    chunk = []
+
+    for item in items:
+        chunk.append(separator + json.dumps(item, sort_keys=True))
+        separator = ","
+        if len(chunk) == STREAM_CHUNK_ITEMS:
+            yield "".join(chunk)
+            chunk = []
+
+    chunk.append("[]" if separator == "[" else "]")
+    yield "".join(chunk)
 
 
 @app.route('/seasons/', methods = ['GET'])
 def get_season_dates():
-    return jsonify(database.get_season_dates())
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    return conditional_get(lambda: jsonify(database.get_season_dates(pool_id)))
 
 
 @app.route('/program/add', methods = ['POST'])
 def post_new_program():
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
     speed = request.args.get(consts.SPEED)
     start = request.args.get(consts.START)
     summer_duration = request.args.get(consts.SUMMER_DURATION)
@@ -75,46 +423,164 @@ def post_new_program():
         }
         return jsonify({"message": "Insufficient information provided to create new program", "parameter": error_response}), 400
 
-    # TODO: Check for correct formatting here
+    try:
+        program = Program.parse(None, pool_id, speed, start, summer_duration, winter_duration)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
     try:
-        database.add_program(speed, start, summer_duration, winter_duration)
+        program = database.add_program(program)
     except sqlite3.IntegrityError:
         return jsonify({"message": "Start times must be unique"}), 400
+    except ProgramOverlapError as e:
+        return overlap_response(e)
 
     with scheduler:
-        scheduler.update_next_event()
+        scheduler.programs_changed(pool_id, [program])
 
     return jsonify({"message": "Successfully added new program"})
 
 
 @app.route('/program/update', methods = ['PUT'])
 def put_update_program():
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
     program_id = request.args.get(consts.ID)
 
     if program_id is None:
         return jsonify({"message": "Did not provide id of program to update"}), 400
 
-    speed = request.args.get(consts.SPEED)
-    start = request.args.get(consts.START)
-    summer_duration = request.args.get(consts.SUMMER_DURATION)
-    winter_duration = request.args.get(consts.WINTER_DURATION)
+    if all(request.args.get(field) is None for field in PROGRAM_FIELDS):
+        return jsonify({"message": "Nothing provided to update the given program"}), 400
 
-    # TODO: Check for correct formatting here
+    try:
+        program_id = parse_id(program_id, "Program")
+        fields = parse_program_fields(request.args)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
-    if speed is None and start is None and summer_duration is None and winter_duration is None:
-        return jsonify({"message": "Nothing provided to update the given program"}), 400
+    try:
+        program = database.update_program(pool_id, program_id, **fields)
+    except sqlite3.IntegrityError:
+        return jsonify({"message": "Start times must be unique"}), 400
+    except ProgramOverlapError as e:
+        return overlap_response(e)
 
-    if not database.update_program(int(program_id), speed, start, summer_duration, winter_duration):
+    if program is None:
         return jsonify({"message": "Passed id was not valid"}), 400
 
     with scheduler:
-        scheduler.update_next_event()
+        scheduler.programs_changed(pool_id, [program])
     return jsonify({"message": "Sucessfully updated program"})
 
 
+PROGRAM_FIELDS = (consts.SPEED, consts.START, consts.SUMMER_DURATION, consts.WINTER_DURATION)
+
+
+def parse_program_fields(values):
+    '''
+    Returns the program fields present in values parsed, times in seconds
+    Raises ValueError for the first one that is malformed
+    '''
+    parsers = (parse_speed, parse_time, parse_time, parse_time)
+    return {field: parse(values[field]) for field, parse in zip(PROGRAM_FIELDS, parsers) if values.get(field) is not None}
+
+
+def overlap_response(error):
+    return jsonify({
+        "message": str(error),
+        consts.PROGRAM: error.program.to_dict(),
+        consts.DATE: error.overlap_date.isoformat()
+    }), 400
+
+
+@app.route('/program/bulk', methods = ['POST'])
+def post_bulk_programs():
+    '''
+    Body: {"add": [{speed, start, summer_duration, winter_duration}, ...],
+           "update": [{id, and any of speed, start, summer_duration, winter_duration}, ...],
+           "delete": [{id}, ...]}
+    Applied in one transaction (deletes, then updates, then adds), nothing is committed if any item fails
+    '''
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    batch = request.get_json(silent=True)
+
+    if not isinstance(batch, dict):
+        return jsonify({"message": "Bulk request body must be a JSON object"}), 400
+
+    adds = batch.get(consts.ADD, [])
+    updates = batch.get(consts.UPDATE, [])
+    deletes = batch.get(consts.DELETE, [])
+    errors = []
+
+    for action, items in ((consts.ADD, adds), (consts.UPDATE, updates), (consts.DELETE, deletes)):
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            return jsonify({"message": "Bulk %s must be a list of objects" % (action, )}), 400
+
+    parsed_adds = []
+    parsed_updates = []
+    deleted_ids = []
+
+    for index, program in enumerate(adds):
+        missing = [field for field in PROGRAM_FIELDS if program.get(field) is None]
+        if missing:
+            errors.append({consts.ACTION: consts.ADD, consts.INDEX: index,
+                           "message": "Insufficient information provided to create new program", "parameter": missing})
+            continue
+
+        try:
+            parsed_adds.append(Program.parse(None, pool_id, program[consts.SPEED], program[consts.START],
+                                             program[consts.SUMMER_DURATION], program[consts.WINTER_DURATION]))
+        except ValueError as e:
+            errors.append({consts.ACTION: consts.ADD, consts.INDEX: index, "message": str(e)})
+
+    for index, program in enumerate(updates):
+        if program.get(consts.ID) is None:
+            errors.append({consts.ACTION: consts.UPDATE, consts.INDEX: index, "message": "Did not provide id of program to update"})
+            continue
+        elif all(program.get(field) is None for field in PROGRAM_FIELDS):
+            errors.append({consts.ACTION: consts.UPDATE, consts.INDEX: index, "message": "Nothing provided to update the given program"})
+            continue
+
+        try:
+            parsed_updates.append(dict(parse_program_fields(program), id=parse_id(program[consts.ID], "Program")))
+        except ValueError as e:
+            errors.append({consts.ACTION: consts.UPDATE, consts.INDEX: index, "message": str(e)})
+
+    for index, program in enumerate(deletes):
+        if program.get(consts.ID) is None:
+            errors.append({consts.ACTION: consts.DELETE, consts.INDEX: index, "message": "Did not provide id of program to delete"})
+            continue
+
+        try:
+            deleted_ids.append(parse_id(program[consts.ID], "Program"))
+        except ValueError as e:
+            errors.append({consts.ACTION: consts.DELETE, consts.INDEX: index, "message": str(e)})
+
+    if errors:
+        return jsonify({"message": "Bulk update rejected, nothing was applied", "errors": errors}), 400
+
+    try:
+        written = database.apply_program_batch(pool_id, parsed_adds, parsed_updates, deleted_ids)
+    except ProgramBatchError as e:
+        return jsonify({"message": "Bulk update rejected, nothing was applied", "errors": e.errors}), 400
+
+    with scheduler:
+        scheduler.programs_changed(pool_id, written, deleted_ids)
+
+    return jsonify({"message": "Successfully applied %d program changes" % (len(adds) + len(updates) + len(deletes), )})
+
+
 @app.route('/override', methods = ['PUT'])
 def put_override():
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
 
     speed = request.args.get(consts.SPEED)
     duration = request.args.get(consts.DURATION)
@@ -122,19 +588,26 @@ def put_override():
     if speed is None:
         return jsonify({"message": "Speed not provided to override"}), 400
 
-    speed = int(speed)
+    try:
+        speed = parse_speed(speed)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
     if speed != 0 and duration is None:
         return jsonify({"message": "Duration not provided to overrride when trying to turn on filter"}), 400
 
+    try:
+        delta = None if speed == 0 else timedelta(seconds=parse_time(duration))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
     try:
 
         with scheduler:
             if speed != 0:
-                time = datetime.strptime(duration, "%H:%M:%S")
-                delta = timedelta(hours=time.hour, minutes=time.minute, seconds=time.second)
-                scheduler.override_current_event(Scheduler.StartEvent(datetime.now(), delta, int(speed)))
+                scheduler.override_current_event(Scheduler.StartEvent(scheduler.clock.now(), delta, speed, pool_id, consts.OVERRIDE))
             else:
-                scheduler.override_current_event(Scheduler.StopEvent(datetime.now()))
+                scheduler.override_current_event(Scheduler.StopEvent(scheduler.clock.now(), pool_id, consts.OVERRIDE))
 
     except Exception as e:
         return jsonify({"message": "Failed to override current event: " + str(e)}), 500
@@ -142,6 +615,192 @@ def put_override():
     return jsonify({"message": "Overwrote current program"})
 
 
+@app.route('/schedule', methods = ['GET'])
+def get_schedule():
+    '''
+    Streams a JSON list of every start and stop of the pool from the from date through the to date (YYYY-MM-DD, inclusive)
+    The range may cover at most MAX_SCHEDULE_DAYS
+    '''
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    try:
+        start = datetime.strptime(request.args.get(consts.FROM, ""), "%Y-%m-%d")
+        end = datetime.strptime(request.args.get(consts.TO, ""), "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        return jsonify({"message": "from and to must be provided as YYYY-MM-DD"}), 400
+    except OverflowError:
+        end = datetime.max
+
+    if end > datetime(MAX_SCHEDULE_YEAR + 1, 1, 1):
+        return jsonify({"message": "to must be in %d or earlier" % (MAX_SCHEDULE_YEAR, )}), 400
+
+    if end <= start:
+        return jsonify({"message": "to must not be before from"}), 400
+
+    if end - start > timedelta(days=MAX_SCHEDULE_DAYS):
+        return jsonify({"message": "from and to may be at most %d days apart" % (MAX_SCHEDULE_DAYS, )}), 400
+
+    def generate():
+        separator = "["
+        for event in database.get_schedule(pool_id, start, end):
+            yield separator + json.dumps(schedule_event_json(event))
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@app.route('/history', methods = ['GET'])
+def get_history():
+    '''
+    Runtime seconds and speed hours of the pool per day (period=day, the default) or month (period=month) and source,
+    optionally from the from date through the to date (YYYY-MM-DD, inclusive)
+    Read from the rollups, a run is counted once it has ended
+    '''
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    period = request.args.get(consts.PERIOD, consts.DAY)
+    if period not in (consts.DAY, consts.MONTH):
+        return jsonify({"message": "period must be day or month"}), 400
+
+    try:
+        first = datetime.strptime(request.args.get(consts.FROM, "0001-01-01"), "%Y-%m-%d").date()
+        last = datetime.strptime(request.args.get(consts.TO, "9999-12-31"), "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"message": "from and to must be provided as YYYY-MM-DD"}), 400
+
+    period_format = "%Y-%m-%d" if period == consts.DAY else "%Y-%m"
+
+    # Runs that ended before this request may still be buffered
+    scheduler.history.flush()
+
+    return jsonify(database.get_runtime_rollups(pool_id, period, first.strftime(period_format), last.strftime(period_format)))
+
+
+@app.route('/telemetry', methods = ['POST'])
+def post_telemetry():
+    '''
+    Body: {"samples": [{time (unix seconds, defaults to now), and any of rpm, watts, pressure, water_temperature}, ...]}
+    Buffered and written in bulk, a query flushes this worker's buffer first
+    '''
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"message": "Telemetry request body must be a JSON object"}), 400
+
+    try:
+        samples = parse_samples(body.get(consts.SAMPLES), time.time())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    telemetry.ingest(pool_id, samples)
+    return jsonify({"message": "Accepted %d telemetry samples" % (len(samples), )})
+
+
+@app.route('/telemetry', methods = ['GET'])
+def get_telemetry():
+    '''
+    Downsampled series of the pool's telemetry from the from datetime through the to datetime (ISO 8601, default the last hour)
+    Datetimes without an offset are local time
+    metric - comma separated metrics, default all
+    step - seconds per point, giving at most MAX_QUERY_POINTS, default the shortest that does
+    resolution=raw returns the samples themselves instead, only kept for a day
+    '''
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
+    try:
+        last = parse_local_datetime(request.args[consts.TO]) if consts.TO in request.args else datetime.now()
+        first = parse_local_datetime(request.args[consts.FROM]) if consts.FROM in request.args else last - timedelta(hours=1)
+        first, last = first.timestamp(), last.timestamp()
+    except (ValueError, OverflowError, OSError):
+        return jsonify({"message": "from and to must be provided as ISO 8601 datetimes within the supported range"}), 400
+
+    if first > last:
+        return jsonify({"message": "from must not be after to"}), 400
+
+    if request.args.get(consts.RESOLUTION) == "raw":
+        samples, truncated = telemetry.get_samples(pool_id, first, last)
+        return jsonify({
+            consts.SAMPLES: [dict({consts.TIME: datetime.fromtimestamp(sample[0]).isoformat()},
+                                  **{metric: value for metric, value in zip(consts.TELEMETRY_METRICS, sample[1:]) if value is not None})
+                             for sample in samples],
+            "truncated": truncated
+        })
+    elif request.args.get(consts.RESOLUTION) is not None:
+        return jsonify({"message": "resolution can only be raw"}), 400
+
+    metrics = request.args.get(consts.METRIC)
+    metrics = consts.TELEMETRY_METRICS if metrics is None else tuple(metrics.split(","))
+    if not all(metric in consts.TELEMETRY_METRICS for metric in metrics):
+        return jsonify({"message": "metric must be any of %s" % (", ".join(consts.TELEMETRY_METRICS), )}), 400
+
+    step = request.args.get(consts.STEP)
+    try:
+        step = None if step is None else int(step)
+    except ValueError:
+        step = -1
+    if step is not None and step <= 0:
+        return jsonify({"message": "step must be a whole number of seconds"}), 400
+
+    if step is not None and (last - first) / step > MAX_QUERY_POINTS:
+        return jsonify({"message": "step must give at most %d points from from through to" % (MAX_QUERY_POINTS, )}), 400
+
+    step, series = telemetry.query(pool_id, first, last, metrics, step)
+
+    return jsonify({
+        consts.STEP: step,
+        "series": {metric: [{consts.TIME: datetime.fromtimestamp(point_time).isoformat(), consts.COUNT: count, consts.MEAN: mean,
+                             consts.MINIMUM: minimum, consts.MAXIMUM: maximum}
+                            for point_time, count, mean, minimum, maximum in points]
+                   for metric, points in series.items()}
+    })
+
+
+def parse_local_datetime(value):
+    '''
+    Returns the ISO 8601 datetime as naive local time, converting one with an offset
+    '''
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+@app.route('/telemetry/stats', methods = ['GET'])
+def get_telemetry_stats():
+    return jsonify(telemetry.get_stats())
+
+
+def schedule_event_json(event):
+    if isinstance(event, Scheduler.StartEvent):
+        return {
+            consts.EVENT: consts.START,
+            consts.TIME: event.event_time.strftime("%Y-%m-%d %H:%M:%S"),
+            consts.DURATION: format_duration(event.duration),
+            consts.SPEED: event.speed
+        }
+
+    return {
+        consts.EVENT: consts.STOP,
+        consts.TIME: event.event_time.strftime("%Y-%m-%d %H:%M:%S"),
+        consts.SPEED: 0
+    }
+
+
+def format_duration(duration):
+    seconds = int(duration.total_seconds())
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
 @app.route('/seasons/update/summer', methods = ['PUT'])
 def put_update_summer():
     return update_season(consts.SUMMER, request.args)
@@ -153,35 +812,51 @@ def put_update_winter():
 
 
 def update_season(season, args):
+    pool_id = get_pool_id(args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
 
     start = args.get(consts.START)
     peak = args.get(consts.PEAK)
 
-    # TODO: Check for correct formatting here
-
     if start is None and peak is None:
         return jsonify({"message": "Nothing provided to update the season"}), 400
 
-    if not database.update_season(season, start, peak):
+    try:
+        start = None if start is None else parse_month_day(start)
+        peak = None if peak is None else parse_month_day(peak)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    if not database.update_season(pool_id, season, start, peak):
         return jsonify({"message": "Failed to update season"}), 500
 
     with scheduler:
-        scheduler.update_next_event()
+        scheduler.seasons_changed(pool_id)
     return jsonify({"message": "Sucessfully updated season"})
 
 
 @app.route('/program/delete', methods = ['DELETE'])
 def delete_program():
+    pool_id = get_pool_id(request.args)
+    if pool_id is None:
+        return jsonify({"message": "Passed pool was not valid"}), 400
+
     program_id = request.args.get(consts.ID)
 
     if program_id is None:
         return jsonify({"message": "Did not provide id of program to delete"}), 400
 
-    if not database.delete_program(int(program_id)):
+    try:
+        program_id = parse_id(program_id, "Program")
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    if not database.delete_program(pool_id, program_id):
         return jsonify({"message": "Passed id was not valid"}), 400
 
     with scheduler:
-        scheduler.update_next_event()
+        scheduler.programs_changed(pool_id, deleted_ids=[program_id])
     return jsonify({"message": "Sucessfully deleted program"})
 
 
@@ -0,0 +1,124 @@
+'''
+Micro-benchmark of per-request SQLite latency
+Compares opening a connection per call (the old Database behaviour) against the pooled connections
+
+Run from the repository root, pointing --dir at the storage to measure (e.g. the Pi's SD card):
+    python src/bench_connections.py --dir /home/pi --iterations 500
+'''
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import consts
+from database import Database
+from models import Program
+
+
+def connect_per_call_read(db_path):
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute('''SELECT * FROM programs ORDER BY start''')
+    cur.fetchall()
+    conn.close()
+
+
+def connect_per_call_programs_seasons(db_path):
+    # get_next_event used to open one connection for the programs and one for the seasons
+    connect_per_call_read(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('''SELECT * FROM seasons''').fetchall()
+    conn.close()
+
+
+def pooled_read(database):
+    # The same query on a pooled connection, Database's own reads are answered from its in-memory caches
+    with database._pool.connection() as conn:
+        conn.execute('''SELECT * FROM programs ORDER BY start''').fetchall()
+
+
+def pooled_programs_seasons(database):
+    with database._pool.connection() as conn:
+        conn.execute('''SELECT * FROM programs ORDER BY start''').fetchall()
+        conn.execute('''SELECT * FROM seasons''').fetchall()
+
+
+def connect_per_call_write(db_path, program_id, speed):
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE programs SET " + consts.SPEED + " = ? WHERE " + consts.ID + " = ?", (speed, program_id))
+    conn.commit()
+    conn.close()
+
+
+def time_calls(function, iterations):
+    '''
+    Returns the latency of each call in milliseconds
+    '''
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite connection micro-benchmark")
+    parser.add_argument("--dir", default=None, help="Directory for the benchmark database (defaults to a temp dir)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--programs", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as bench_dir:
+        db_path = os.path.join(bench_dir, "bench.db")
+        database = Database("test", db_path)
+
+        for i in range(args.programs):
+            database.add_program(Program(None, consts.DEFAULT_POOL_ID, 1, i * 3600, 3600, 1800))
+        program_id = database.get_all_programs(consts.DEFAULT_POOL_ID)[0].id
+
+        cases = {
+            "read": (lambda i: connect_per_call_read(db_path),
+                     lambda i: pooled_read(database)),
+            "programs_seasons": (lambda i: connect_per_call_programs_seasons(db_path),
+                                 lambda i: pooled_programs_seasons(database)),
+            "write": (lambda i: connect_per_call_write(db_path, program_id, i % 4),
+                      lambda i: database.update_program(consts.DEFAULT_POOL_ID, program_id, speed=i % 4)),
+        }
+
+        results = {}
+        for name, (per_call, pooled) in cases.items():
+            results[name] = {
+                "connect_per_call": summarize(time_calls(per_call, args.iterations)),
+                "pooled": summarize(time_calls(pooled, args.iterations)),
+            }
+
+        database.close()
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    for name, result in results.items():
+        per_call = result["connect_per_call"]
+        pooled = result["pooled"]
+        print("%-16s connect per call: mean %.3f ms, p99 %.3f ms | pooled: mean %.3f ms, p99 %.3f ms | %.1fx"
+              % (name, per_call["mean_ms"], per_call["p99_ms"], pooled["mean_ms"], pooled["p99_ms"],
+                 per_call["mean_ms"] / pooled["mean_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+'''
+Benchmark suite for the scheduling math and the HTTP endpoints
+Seeds a scratch database with each program count, times the Database scheduling functions directly
+and every route through the Flask test client, then prints the results as JSON
+
+Run from the repository root:
+    python src/benchmark.py --output bench.json
+    python src/benchmark.py --compare bench.json    # exits 1 if anything got slower than --threshold
+'''
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+# The app module builds its own database at import unless it is told this is not production
+os.environ["FLASK_ENV"] = "development"
+os.environ.pop("WERKZEUG_RUN_MAIN", None)
+
+import app as app_module
+import consts
+import firmware
+from actuator import Actuator
+from database import Database
+from models import Program
+from scheduler import Scheduler
+
+DEFAULT_SIZES = [10, 1000, 100000]
+# A pool can hold at most one program per second of the day
+PROGRAMS_PER_POOL = 50000
+# Fixed so every run times the same work
+RANDOM_SEED = 20200601
+SCHEDULE_DAYS = 1
+# A case stops repeating once it has run this long, so whole-table endpoints stay bounded at the largest sizes
+CASE_BUDGET_SECONDS = 5.0
+MIN_ITERATIONS = 3
+
+
+def seed_database(database, program_count):
+    '''
+    Spreads program_count evenly spaced programs over as few pools as possible, returns the pool ids
+    '''
+    pool_ids = []
+    remaining = program_count
+
+    while remaining > 0:
+        pool_count = min(remaining, PROGRAMS_PER_POOL)
+        pool_id = consts.DEFAULT_POOL_ID if not pool_ids else database.add_pool(len(pool_ids))
+        step = 86400 // pool_count
+
+        adds = [Program(None, pool_id, 1 + i % 4, i * step, step // 2, step // 4) for i in range(pool_count)]
+        database.apply_program_batch(pool_id, adds)
+
+        pool_ids.append(pool_id)
+        remaining -= pool_count
+
+    return pool_ids
+
+
+def format_seconds(seconds):
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def time_calls(function, iterations):
+    '''
+    Calls function(i) up to iterations times or until CASE_BUDGET_SECONDS, returns latency statistics in microseconds
+    '''
+    function(0)
+
+    latencies = []
+    budget_end = time.perf_counter() + CASE_BUDGET_SECONDS
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        end = time.perf_counter()
+        latencies.append((end - start) * 1000000)
+
+        if end > budget_end and len(latencies) >= MIN_ITERATIONS:
+            break
+
+    latencies.sort()
+    return {
+        "iterations": len(latencies),
+        "mean_us": statistics.mean(latencies),
+        "p50_us": latencies[len(latencies) // 2],
+        "p99_us": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    }
+
+
+def benchmark_size(program_count, iterations, bench_dir):
+    database = Database("test", os.path.join(bench_dir, "bench_%d.db" % (program_count, )))
+    seed_start = time.perf_counter()
+    pool_ids = seed_database(database, program_count)
+    seed_seconds = time.perf_counter() - seed_start
+
+    scheduler = Scheduler(database, Actuator(firmware.SimulatedFirmware(0)))
+    app_module.database = database
+    app_module.scheduler = scheduler
+    client = app_module.app.test_client()
+
+    pool_id = pool_ids[0]
+    programs = database.get_all_programs(pool_id)
+    seasons = database.get_seasons(pool_id)
+
+    rng = random.Random(RANDOM_SEED)
+    times = [datetime(2021, 1, 1) + timedelta(seconds=rng.randrange(365 * 86400)) for _ in range(iterations)]
+    picks = [programs[rng.randrange(len(programs))] for _ in range(iterations)]
+
+    def program_at(i):
+        return picks[i % iterations]
+
+    def day_at(i):
+        return times[i % iterations].date()
+
+    functions = {
+        "get_next_program": lambda i: database.get_next_program(pool_id, times[i % iterations]),
+        "get_next_event": lambda i: database.get_next_event(pool_id, times[i % iterations]),
+        "get_interpolated_duration": lambda i: database.get_interpolated_duration(
+            pool_id, day_at(i), program_at(i).summer_duration, program_at(i).winter_duration),
+        "get_duration_chart": lambda i: database.get_duration_chart(
+            day_at(i), program_at(i).summer_duration, program_at(i).winter_duration, seasons),
+        "get_previous_next_events": lambda i: database.get_previous_next_events(
+            day_at(i), database.get_duration_chart(day_at(i), program_at(i).summer_duration, program_at(i).winter_duration, seasons)),
+    }
+
+    schedule_from = date(2021, 6, 1)
+    schedule_to = schedule_from + timedelta(days=SCHEDULE_DAYS - 1)
+    spare_start = format_seconds(86400 - 1)
+
+    def add_then_delete(i):
+        client.post("/program/add?pool=%d&speed=1&start=%s&summer_duration=00:00:00&winter_duration=00:00:00" % (pool_id, spare_start))
+        added = database.get_next_program(pool_id, datetime(2021, 1, 1, 23, 59, 59))[0]
+        client.delete("/program/delete?pool=%d&id=%d" % (pool_id, added.id))
+
+    def current_etag():
+        return '"%s-%d"' % (database.instance_token, database.data_version)
+
+    endpoints = {
+        "GET /program/now": lambda i: client.get("/program/now?pool=%d" % (pool_id, )),
+        # The list is streamed, reading the body is what times its serialization
+        "GET /program/all": lambda i: client.get("/program/all?pool=%d" % (pool_id, )).get_data(),
+        "GET /program/all (If-None-Match)": lambda i: client.get("/program/all?pool=%d" % (pool_id, ), headers={"If-None-Match": current_etag()}),
+        "GET /seasons/": lambda i: client.get("/seasons/?pool=%d" % (pool_id, )),
+        "GET /schedule (%d day)" % (SCHEDULE_DAYS, ): lambda i: client.get("/schedule?pool=%d&from=%s&to=%s" % (pool_id, schedule_from, schedule_to)).get_data(),
+        "PUT /program/update": lambda i: client.put("/program/update?pool=%d&id=%d&speed=%d" % (pool_id, program_at(i).id, 1 + i % 4)),
+        "PUT /seasons/update/summer": lambda i: client.put("/seasons/update/summer?pool=%d&peak=7-%d" % (pool_id, 10 + i % 10)),
+        "PUT /override": lambda i: client.put("/override?pool=%d&speed=0" % (pool_id, )),
+        "POST /program/add + DELETE /program/delete": add_then_delete,
+    }
+
+    results = []
+    for kind, cases in (("function", functions), ("endpoint", endpoints)):
+        for name, function in cases.items():
+            result = {"programs": program_count, "kind": kind, "name": name}
+            result.update(time_calls(function, iterations))
+            results.append(result)
+
+    database.close()
+    return seed_seconds, results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    '''
+    Returns the cases whose mean got slower than threshold times the baseline
+    '''
+    baseline_means = {(result["programs"], result["name"]): result["mean_us"] for result in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        baseline_mean = baseline_means.get((result["programs"], result["name"]))
+        if baseline_mean and result["mean_us"] > baseline_mean * threshold:
+            regressions.append({"programs": result["programs"], "name": result["name"],
+                                "baseline_mean_us": baseline_mean, "mean_us": result["mean_us"],
+                                "ratio": result["mean_us"] / baseline_mean})
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scheduling and endpoint benchmark suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Program counts to seed")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="Baseline JSON results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio counted as a regression")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "iterations": args.iterations,
+            "seed": RANDOM_SEED,
+            "timestamp": datetime.now().isoformat()
+        },
+        "seed_seconds": {},
+        "results": []
+    }
+
+    real_stdout = sys.stdout
+    with tempfile.TemporaryDirectory() as bench_dir, open(os.devnull, "w") as devnull:
+        # The scheduler and firmware log every event, keep that out of the results
+        with contextlib.redirect_stdout(devnull):
+            for size in args.sizes:
+                seed_seconds, results = benchmark_size(size, args.iterations, bench_dir)
+                report["seed_seconds"][str(size)] = seed_seconds
+                report["results"].extend(results)
+                print("%d programs done" % (size, ), file=sys.stderr)
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            report["regressions"] = compare(report["results"], json.load(baseline_file), args.threshold)
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        real_stdout.write(output + "\n")
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import collections
+import threading
+
+# Updates a subscriber may fall behind by, each is a full state so dropping the oldest loses nothing a client needs
+MAX_QUEUED_UPDATES = 16
+# Open streams each hold a server thread, more are refused
+MAX_SUBSCRIBERS = 256
+
+
+class Broadcaster():
+    '''
+    Fans pool state changes out to stream subscribers
+    publish only appends to bounded per-subscriber queues, so it is safe under the scheduler lock and a slow client never blocks it
+    '''
+
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS, max_queued=MAX_QUEUED_UPDATES):
+        self._max_subscribers = max_subscribers
+        self._max_queued = max_queued
+        self._lock = threading.Lock()
+        # pool id -> set of Broadcaster.Subscription
+        self._subscribers = collections.defaultdict(set)
+        self._subscriber_count = 0
+        # pool id -> last published state, a publish that changes nothing is not sent
+        self._last_published = {}
+        self._dropped_count = 0
+
+
+    def subscribe(self, pool_id):
+        '''
+        Returns a Subscription to the pool's state changes, or None when MAX_SUBSCRIBERS are already open
+        The caller must close it
+        '''
+        with self._lock:
+            if self._subscriber_count >= self._max_subscribers:
+                return None
+
+            subscription = Broadcaster.Subscription(self, pool_id, self._max_queued)
+            self._subscribers[pool_id].add(subscription)
+            self._subscriber_count += 1
+            return subscription
+
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.pool_id)
+            if subscribers is None or subscription not in subscribers:
+                return
+
+            subscribers.discard(subscription)
+            self._subscriber_count -= 1
+            if not subscribers:
+                del self._subscribers[subscription.pool_id]
+                # Nothing is published without subscribers, so the last state would go stale
+                self._last_published.pop(subscription.pool_id, None)
+
+
+    def has_subscribers(self, pool_id):
+        return pool_id in self._subscribers
+
+
+    def publish(self, pool_id, state):
+        '''
+        Queues state for every subscriber of the pool unless it is the state last published, never blocks
+        '''
+        with self._lock:
+            if self._last_published.get(pool_id) == state:
+                return
+            self._last_published[pool_id] = state
+
+            for subscription in self._subscribers.get(pool_id, ()):
+                if subscription._push(state):
+                    self._dropped_count += 1
+
+
+    def close_pool(self, pool_id):
+        '''
+        Ends every subscription to a removed pool
+        '''
+        with self._lock:
+            self._last_published.pop(pool_id, None)
+            subscribers = self._subscribers.pop(pool_id, set())
+            self._subscriber_count -= len(subscribers)
+
+        for subscription in subscribers:
+            subscription._close()
+
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "subscribers": self._subscriber_count,
+                "dropped": self._dropped_count
+            }
+
+
+    class Subscription():
+        '''
+        One client's queue of states, read by the thread serving its stream
+        '''
+        def __init__(self, broadcaster, pool_id, max_queued):
+            self.pool_id = pool_id
+            self._broadcaster = broadcaster
+            self._queue = collections.deque(maxlen=max_queued)
+            self._ready = threading.Event()
+            self._closed = False
+
+
+        def _push(self, state):
+            '''
+            Returns True if the oldest queued state was dropped to make room
+            '''
+            dropped = len(self._queue) == self._queue.maxlen
+            self._queue.append(state)
+            self._ready.set()
+            return dropped
+
+
+        def _close(self):
+            self._closed = True
+            self._ready.set()
+
+
+        def get(self, timeout):
+            '''
+            Waits up to timeout seconds, returns the states queued since the last call (empty on timeout)
+            or None once the subscription was ended
+            '''
+            self._ready.wait(timeout)
+            # Cleared before draining, a state pushed after the drain sets it again rather than being missed
+            self._ready.clear()
+
+            states = []
+            while self._queue:
+                states.append(self._queue.popleft())
+
+            if not states and self._closed:
+                return None
+            return states
+
+
+        def close(self):
+            self._broadcaster._unsubscribe(self)
@@ -0,0 +1,44 @@
+from writebehind import WriteBehindBuffer
+
+
+class StateCheckpoint():
+    '''
+    Write-behind copy of each pool's current and next event, so a restart can resume a run in progress
+    The scheduler hands over its snapshot under its lock, it is committed as soon as the writer is free
+    Only the latest snapshot of a pool is kept, transitions made during a write are coalesced into the next one
+    '''
+
+    def __init__(self, database):
+        self.database = database
+
+        # pool id -> Scheduler.Snapshot, or None once the pool was removed
+        self._snapshots = WriteBehindBuffer(self._write, "scheduler state checkpoint", keyed=True)
+
+
+    def load(self):
+        '''
+        Returns pool id -> (current event dict, next event dict) as last written
+        '''
+        return self.database.get_scheduler_states()
+
+
+    def save(self, pool_id, snapshot):
+        '''
+        Queues the pool's snapshot
+        '''
+        self._snapshots.add([(pool_id, snapshot)])
+
+
+    def remove(self, pool_id):
+        self.save(pool_id, None)
+
+
+    def _write(self, snapshots):
+        # Events are never modified once made, so they can be read without the scheduler lock
+        states = {pool_id: None if snapshot is None else (to_dict(snapshot.current_event), to_dict(snapshot.next_event))
+                  for pool_id, snapshot in snapshots.items()}
+        self.database.save_scheduler_states(states)
+
+
+def to_dict(event):
+    return None if event is None else event.to_dict()
@@ -0,0 +1,66 @@
+import threading
+import time
+from datetime import datetime
+
+# Longest the event thread sleeps before re-reading the clock, bounds the error from wall clock steps (e.g. NTP after boot)
+MAX_WAIT_SECONDS = 60
+
+
+class Clock():
+    '''
+    Wall clock, everything that schedules by the time of day reads it through one of these so a simulation can swap it
+    '''
+
+    def now(self):
+        return datetime.now()
+
+
+    def time(self):
+        return time.time()
+
+
+    def wait(self, condition, timeout=None):
+        '''
+        [REQUIRES CONDITION]
+        Sleeps on condition until notified or timeout seconds have passed, None waits for a notify
+        '''
+        if timeout is None:
+            condition.wait()
+        else:
+            condition.wait(min(timeout, MAX_WAIT_SECONDS))
+
+
+class VirtualClock(Clock):
+    '''
+    Clock that only moves when the scheduler sleeps, jumping straight to the deadline it sleeps until
+    Stops at end, the sleeper then blocks and finished is set, so a year of events runs as fast as they can be invoked
+    Only for a scheduler with no other threads scheduling events, a notify from elsewhere would not wake a jump early
+    '''
+
+    def __init__(self, start, end):
+        self._timestamp = start.timestamp()
+        self._end_timestamp = end.timestamp()
+        self.finished = threading.Event()
+
+
+    def now(self):
+        return datetime.fromtimestamp(self._timestamp)
+
+
+    def time(self):
+        return self._timestamp
+
+
+    def wait(self, condition, timeout=None):
+        # Nothing scheduled yet, time stands still until something is
+        if timeout is None:
+            condition.wait()
+            return
+
+        if self._timestamp + timeout >= self._end_timestamp:
+            self._timestamp = max(self._timestamp, self._end_timestamp)
+            self.finished.set()
+            condition.wait()
+            return
+
+        self._timestamp += timeout
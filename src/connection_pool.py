@@ -0,0 +1,213 @@
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+
+# Statements kept compiled per connection by sqlite3's statement cache
+STATEMENT_CACHE_SIZE = 128
+
+# Idle connections kept open for reuse, extra connections are closed on release
+MAX_IDLE_CONNECTIONS = 8
+
+# Milliseconds a writer waits on another writer before raising "database is locked"
+BUSY_TIMEOUT_MS = 5000
+
+QUERY_SECONDS = metrics.REGISTRY.histogram("poolfilter_sqlite_query_seconds",
+                                           "SQLite statement time, execute covers the first step and fetch reading the rest of the rows",
+                                           ("statement", "phase"))
+
+# Distinct statements get their own series, savepoint names are numbered so they share one label
+SAVEPOINT_NAME = re.compile(r"\bsp\d+\b")
+MAX_STATEMENT_LABELS = 256
+_statement_labels = {}
+
+
+def get_statement_label(sql):
+    label = _statement_labels.get(sql)
+    if label is None:
+        label = SAVEPOINT_NAME.sub("sp", " ".join(sql.split()))
+        if len(_statement_labels) < MAX_STATEMENT_LABELS:
+            _statement_labels[sql] = label
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    '''
+    Cursor that records how long each statement and its fetchone/fetchall take
+    '''
+
+    def execute(self, sql, parameters=()):
+        self._statement = get_statement_label(sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, self._statement, "execute")
+
+
+    def executemany(self, sql, seq_of_parameters):
+        self._statement = get_statement_label(sql)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, self._statement, "execute")
+
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        QUERY_SECONDS.observe(time.perf_counter() - start, self._statement, "fetch")
+        return row
+
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        QUERY_SECONDS.observe(time.perf_counter() - start, self._statement, "fetch")
+        return rows
+
+
+class TimedConnection(sqlite3.Connection):
+    '''
+    Connection whose execute shortcuts go through TimedCursor
+    '''
+
+    def execute(self, sql, parameters=()):
+        return self.cursor(TimedCursor).execute(sql, parameters)
+
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor(TimedCursor).executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool():
+    '''
+    Pool of long-lived SQLite connections
+    A thread keeps the same connection for the whole (possibly nested) block it checked it out for
+    Connections are opened in autocommit mode so transactions are always explicit
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._savepoint_id = 0
+
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path,
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE,
+                               factory=TimedConnection)
+
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL is durable across power loss at NORMAL, without an fsync per commit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=%d" % (BUSY_TIMEOUT_MS, ))
+
+        return conn
+
+
+    def _checkout(self):
+        with self._idle_lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+
+    def _checkin(self, conn):
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+
+        with self._idle_lock:
+            if len(self._idle) < MAX_IDLE_CONNECTIONS:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+    @contextmanager
+    def connection(self):
+        '''
+        Yields a pooled connection bound to the calling thread
+        Nested calls on the same thread get the same connection
+        '''
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(conn)
+
+
+    @contextmanager
+    def committed_connection(self):
+        '''
+        Yields a connection that only sees committed data
+        That is the thread's own connection unless it is inside a transaction, then a separate pooled one
+        '''
+        conn = getattr(self._local, "conn", None)
+        if conn is None or not conn.in_transaction:
+            with self.connection() as conn:
+                yield conn
+            return
+
+        separate = self._checkout()
+        try:
+            yield separate
+        finally:
+            self._checkin(separate)
+
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Yields a connection inside BEGIN IMMEDIATE ... COMMIT
+        Nested transactions become savepoints of the outer one
+        Rolls back if the block raises
+        '''
+        with self.connection() as conn:
+            if conn.in_transaction:
+                self._savepoint_id += 1
+                savepoint = "sp%d" % (self._savepoint_id, )
+                begin = ["SAVEPOINT " + savepoint]
+                commit = ["RELEASE " + savepoint]
+                rollback = ["ROLLBACK TO " + savepoint, "RELEASE " + savepoint]
+            else:
+                begin = ["BEGIN IMMEDIATE"]
+                commit = ["COMMIT"]
+                rollback = ["ROLLBACK"]
+
+            self._execute_all(conn, begin)
+            try:
+                yield conn
+            except BaseException:
+                self._execute_all(conn, rollback)
+                raise
+            self._execute_all(conn, commit)
+
+
+    @staticmethod
+    def _execute_all(conn, statements):
+        for statement in statements:
+            conn.execute(statement)
+
+
+    def close_all(self):
+        with self._idle_lock:
+            idle = self._idle
+            self._idle = []
+
+        for conn in idle:
+            conn.close()
@@ -1,3 +1,16 @@
+POOLS = "pools"
+POOL = "pool"
+POOL_ID = "pool_id"
+CONTROLLER = "controller"
+CONTROLLER_ID = "controller_id"
+PROGRAMS = "programs"
+PROGRAM = "program"
+PROGRAM_ID = "program_id"
+
+# Pool used when a request does not name one, programs from before multiple pools belong to it
+DEFAULT_POOL_ID = 1
+DEFAULT_CONTROLLER_ID = 0
+
 SEASONS = "seasons"
 SEASON = "season"
 SUMMER = "summer"
@@ -13,9 +26,55 @@ SUMMER_DURATION = "summer_duration"
 WINTER_DURATION = "winter_duration"
 DURATION = "duration"
 
+LIMIT = "limit"
+CURSOR = "cursor"
+FIELDS = "fields"
+
+ACTION = "action"
+INDEX = "index"
+ADD = "add"
+UPDATE = "update"
+DELETE = "delete"
+
+EVENT = "event"
+CURRENT_EVENT = "current_event"
+NEXT_EVENT = "next_event"
+TIME = "time"
+VERSION = "version"
+TOKEN = "token"
+STOP = "stop"
+FROM = "from"
+TO = "to"
+DATE = "date"
+
+# Run history, a run's source is PROGRAM or OVERRIDE
+SOURCE = "source"
+OVERRIDE = "override"
+PERIOD = "period"
+RUNTIME_SECONDS = "runtime_seconds"
+SPEED_HOURS = "speed_hours"
+
 DAY = "day"
 MONTH = "month"
 
+# Pump telemetry, each sample has a time and any of the metrics
+TELEMETRY = "telemetry"
+SAMPLES = "samples"
+RPM = "rpm"
+WATTS = "watts"
+PRESSURE = "pressure"
+WATER_TEMPERATURE = "water_temperature"
+TELEMETRY_METRICS = (RPM, WATTS, PRESSURE, WATER_TEMPERATURE)
+METRIC = "metric"
+RESOLUTION = "resolution"
+BUCKET = "bucket"
+STEP = "step"
+COUNT = "count"
+TOTAL = "total"
+MINIMUM = "minimum"
+MAXIMUM = "maximum"
+MEAN = "mean"
+
 START_MONTH = START + "_" + MONTH
 START_DAY = START + "_" + DAY
 
@@ -1,9 +1,21 @@
-import sqlite3
+import collections
 import json
+import mmap
+import sqlite3
+import struct
 import scheduler
 import os
 import consts
-from datetime import datetime, timedelta
+import migrations
+from clock import Clock
+from connection_pool import ConnectionPool
+from models import Program, Season, parse_month_day
+from program_index import SECONDS_PER_DAY, ProgramIndex
+from array import array
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from types import MappingProxyType
+import threading
 import time
 
 DB_FOLDER_NAME = "database/"
@@ -11,42 +23,93 @@ PROD_NAME = "database.db"
 TEST_NAME = "test_database.db"
 DEFAULT_FILE_NAME = "defaults.json"
 
+# Beside the database file, holds the data version last committed by any process as a little-endian 64 bit int
+VERSION_FILE_SUFFIX = "-version"
+VERSION_FORMAT = "<Q"
+
+# Duration curves kept, least recently used first out, each is about 3 KB
+MAX_DURATION_CURVES = 2048
+
+# Explicit column order for the positional reads in Program.from_row
+PROGRAM_SELECT = "SELECT id, speed, start, summer_duration, winter_duration, pool_id FROM programs"
+
+
+class ProgramBatchError(Exception):
+    '''
+    Raised when any item of a program batch fails, nothing from the batch was committed
+    errors - list of {action, index, message} for every failed item
+    '''
+    def __init__(self, errors):
+        super().__init__("%d program batch item(s) failed" % (len(errors), ))
+        self.errors = errors
+
+
+class ProgramOverlapError(ValueError):
+    '''
+    Raised when a program would run into another program of its pool, or another into it
+    program - the other models.Program
+    overlap_date - first date from today the two overlap, the date the earlier of the two starts
+    '''
+    def __init__(self, program, overlap_date):
+        super().__init__("Program would overlap program %d on %s" % (program.id, overlap_date.isoformat()))
+        self.program = program
+        self.overlap_date = overlap_date
+
+
 class Database():
 
-    def __init__(self, database_type):
+    def __init__(self, database_type, db_path=None, clock=None):
 
-        self.DB_PATH = self._get_db_path(database_type)
+        self.clock = clock if clock is not None else Clock()
+        self.DB_PATH = db_path if db_path is not None else self._get_db_path(database_type)
         print("Initalizing database %s!" % (self.DB_PATH, ))
-        conn = sqlite3.connect(self.DB_PATH)
-
-        conn.execute("CREATE TABLE IF NOT EXISTS seasons ("
-                            + consts.SEASON + " text PRIMARY KEY,"
-                            + consts.START_MONTH + " int NOT NULL,"
-                            + consts.START_DAY + " int NOT NULL,"
-                            + consts.PEAK_MONTH + " int NOT NULL,"
-                            + consts.PEAK_DAY + " int NOT NULL)")
-
-        conn.execute("CREATE TABLE IF NOT EXISTS programs ("
-                            + consts.ID + " INTEGER PRIMARY KEY AUTOINCREMENT,"
-                            + consts.SPEED + " int NOT NULL,"
-                            + consts.START + " time UNIQUE NOT NULL,"
-                            + consts.SUMMER_DURATION + " time NOT NULL,"
-                            + consts.WINTER_DURATION + " time NOT NULL)")
+        self._pool = ConnectionPool(self.DB_PATH)
 
-        defaults = Database.get_defaults()
+        # In-memory copies of the pools, programs and seasons tables, keyed by (table, pool id)
+        # Program indexes are patched after each committed write, other snapshots are dropped and reloaded
+        self._cache_lock = threading.Lock()
+        self._snapshots = {}
+
+        # Serializes writers so committed changes reach the caches in commit order
+        self._write_lock = threading.RLock()
+        # Cache updates of the open write transaction, applied once it commits
+        self._pending_changes = []
+        # Programs written by the open write transaction, so overlap checks later in it see them
+        # pool id -> (ProgramIndex of added and updated programs, ids removed from the committed index)
+        self._pending_programs = {}
+
+        # Per-day duration curves keyed by (year, summer_duration, winter_duration, season config), most recently used last
+        self._curve_lock = threading.Lock()
+        self._duration_curves = collections.OrderedDict()
 
-        conn.execute('''INSERT OR IGNORE INTO seasons VALUES (?, ?, ?, ?, ?)''',
-                       (consts.SUMMER,
-                       *Database.get_month_day(defaults[consts.SEASONS][consts.SUMMER][consts.START]),
-                       *Database.get_month_day(defaults[consts.SEASONS][consts.SUMMER][consts.PEAK])))
+        # A current database needs one PRAGMA read, the defaults file is only read when seeding
+        with self._pool.connection() as conn:
+            if not migrations.is_current(conn):
+                with self._pool.transaction() as conn:
+                    migrations.migrate(conn, self._insert_default_seasons)
 
-        conn.execute('''INSERT OR IGNORE INTO seasons VALUES (?, ?, ?, ?, ?)''',
-                       (consts.WINTER,
-                       *Database.get_month_day(defaults[consts.SEASONS][consts.WINTER][consts.START]),
-                       *Database.get_month_day(defaults[consts.SEASONS][consts.WINTER][consts.PEAK])))
+            # The caches are tagged with the shared write counter, other workers writing the same file bump it too
+            self._data_version, self.instance_token = conn.execute('''SELECT version, token FROM data_version''').fetchone()
 
-        conn.commit()
-        conn.close()
+        # Shared memory copy of the version, checked on every cache read so it must not cost a query, see _sync_data_version
+        self._version_map = Database._map_version_file(self.DB_PATH + VERSION_FILE_SUFFIX)
+        self._version_hint = None
+
+
+    def _insert_default_seasons(self, conn, pool_id):
+        defaults = Database.get_defaults()
+
+        conn.execute('''INSERT OR IGNORE INTO seasons VALUES (?, ?, ?, ?, ?, ?)''',
+                       (pool_id,
+                       consts.SUMMER,
+                       *parse_month_day(defaults[consts.SEASONS][consts.SUMMER][consts.START]),
+                       *parse_month_day(defaults[consts.SEASONS][consts.SUMMER][consts.PEAK])))
+
+        conn.execute('''INSERT OR IGNORE INTO seasons VALUES (?, ?, ?, ?, ?, ?)''',
+                       (pool_id,
+                       consts.WINTER,
+                       *parse_month_day(defaults[consts.SEASONS][consts.WINTER][consts.START]),
+                       *parse_month_day(defaults[consts.SEASONS][consts.WINTER][consts.PEAK])))
 
 
     def _get_db_path(self, database_type):
@@ -59,92 +122,361 @@ class Database():
         return os.path.join(DB_FOLDER_NAME, database_file_name)
 
 
+    def close(self):
+        self._version_map.close()
+        self._pool.close_all()
+
+
     @staticmethod
-    def get_defaults():
-        defaults_file = open(os.path.join(DB_FOLDER_NAME, DEFAULT_FILE_NAME))
-        return json.load(defaults_file)
+    def _map_version_file(path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < struct.calcsize(VERSION_FORMAT):
+                os.ftruncate(fd, struct.calcsize(VERSION_FORMAT))
+            return mmap.mmap(fd, struct.calcsize(VERSION_FORMAT))
+        finally:
+            # The mapping keeps its own reference to the file
+            os.close(fd)
+
+
+    @property
+    def data_version(self):
+        '''
+        Monotonically increasing counter, bumped after every committed write to pools, programs or seasons
+        Shared by every process using the database, as of the last cache read in this one
+        '''
+        return self._data_version
+
+
+    def _sync_data_version(self):
+        '''
+        Drops the caches if another process committed a write since they were last checked
+        Writers store their version in the mapped file after committing, racing writers may leave an older one there
+        but never one a reader has already seen, so any change is only a hint to read the real version from SQLite
+        '''
+        version_hint = struct.unpack_from(VERSION_FORMAT, self._version_map)[0]
+        if version_hint == self._version_hint:
+            return
+
+        with self._pool.committed_connection() as conn:
+            version = conn.execute('''SELECT version FROM data_version''').fetchone()[0]
+
+        with self._cache_lock:
+            self._version_hint = version_hint
+            # Commits of this process leave the version as the caches have it
+            if version > self._data_version:
+                self._snapshots = {}
+                self._data_version = version
+
+
+    @contextmanager
+    def _write(self):
+        '''
+        Yields a connection inside a write transaction
+        Cache changes registered with _on_commit are applied only once the outermost transaction has committed,
+        so a reader can never cache data older than the version it is tagged with
+        Changes from a nested transaction that rolls back are discarded
+        A transaction that changed no rows leaves data_version alone, so a rejected write keeps every cache and ETag
+        Only the cached tables (pools, programs, seasons) are written through here, the run log, scheduler checkpoint
+        and telemetry use plain transactions so their constant writes never invalidate the caches
+        '''
+        with self._write_lock, self._pool.connection() as conn:
+            outermost = not conn.in_transaction
+            pending_count = len(self._pending_changes)
+            total_changes = conn.total_changes
+            version = None
+
+            try:
+                with self._pool.transaction() as conn:
+                    yield conn
+                    if outermost and (conn.total_changes != total_changes or self._pending_changes):
+                        version = conn.execute('''UPDATE data_version SET version = version + 1 RETURNING version''').fetchone()[0]
+            except BaseException:
+                del self._pending_changes[pending_count:]
+                raise
+            finally:
+                if outermost:
+                    self._pending_programs = {}
+
+            if version is not None:
+                with self._cache_lock:
+                    if version == self._data_version + 1:
+                        for change in self._pending_changes:
+                            change()
+                    elif version > self._data_version:
+                        # Another process wrote since the caches were last checked, patching them would keep its changes out
+                        self._snapshots = {}
+                    self._data_version = max(self._data_version, version)
+                self._pending_changes = []
+
+                # After the commit, a process reloading on the hint must find the write in SQLite
+                struct.pack_into(VERSION_FORMAT, self._version_map, 0, version)
+
+
+    def _on_commit(self, change):
+        '''
+        [REQUIRES _write]
+        Registers change() to update the caches once the current write commits, it runs under the cache lock
+        '''
+        self._pending_changes.append(change)
+
+
+    def _pending_add(self, program):
+        '''
+        [REQUIRES _write]
+        Makes a program written by this transaction visible to the overlap checks after it
+        '''
+        pending_index, _ = self._get_pending_programs(program.pool_id)
+        pending_index.add(program)
+
+
+    def _pending_remove(self, pool_id, program_id):
+        '''
+        [REQUIRES _write]
+        '''
+        pending_index, removed_ids = self._get_pending_programs(pool_id)
+        pending_index.remove(program_id)
+        removed_ids.add(program_id)
+
+
+    def _get_pending_programs(self, pool_id):
+        pending_programs = self._pending_programs.get(pool_id)
+        if pending_programs is None:
+            pending_programs = self._pending_programs[pool_id] = (ProgramIndex(), set())
+        return pending_programs
+
+
+    def _index_add(self, program):
+        program_index = self._snapshots.get((consts.PROGRAMS, program.pool_id))
+        if program_index is not None:
+            program_index.add(program)
+
+
+    def _index_remove(self, pool_id, program_id):
+        program_index = self._snapshots.get((consts.PROGRAMS, pool_id))
+        if program_index is not None:
+            program_index.remove(program_id)
+
+
+    def _drop_snapshot(self, key):
+        self._snapshots.pop(key, None)
+
+
+    def _get_snapshot(self, key, load):
+        '''
+        Returns the cached snapshot for key, calling load() to rebuild it from SQLite if it was invalidated
+        Loaders read through committed_connection, a load inside a write transaction must not cache its uncommitted rows
+        '''
+        self._sync_data_version()
+
+        with self._cache_lock:
+            snapshot = self._snapshots.get(key)
+            version = self._data_version
+
+        if snapshot is not None:
+            return snapshot
+
+        snapshot = load()
+
+        with self._cache_lock:
+            # A write committed while loading, the snapshot may already be stale so do not keep it
+            if version == self._data_version:
+                self._snapshots[key] = snapshot
+
+        return snapshot
+
+
+    def get_all_pools(self):
+        return [dict(pool) for pool in self._get_pools_snapshot()]
+
+
+    def has_pool(self, pool_id):
+        return any(pool[consts.ID] == pool_id for pool in self._get_pools_snapshot())
+
+
+    def _get_pools_snapshot(self):
+        return self._get_snapshot((consts.POOLS, ), self._load_pools)
+
+
+    def _load_pools(self):
+        with self._pool.committed_connection() as conn:
+            rows = conn.execute('''SELECT * FROM pools ORDER BY id''').fetchall()
+
+        return tuple(MappingProxyType({consts.ID: pool[0], consts.CONTROLLER_ID: pool[1]}) for pool in rows)
+
+
+    def add_pool(self, controller_id):
+        '''
+        Creates a pool driven by controller_id with the default seasons, returns its id
+        '''
+        with self._write() as conn:
+            pool_id = conn.execute('''INSERT INTO pools VALUES (NULL, ?)''', (controller_id, )).lastrowid
+            self._insert_default_seasons(conn, pool_id)
+            self._on_commit(lambda: self._drop_snapshot((consts.POOLS, )))
+
+        return pool_id
+
+
+    def delete_pool(self, pool_id):
+        '''
+        Deletes the pool with all of its programs and seasons
+        '''
+        with self._write() as conn:
+            delete_count = conn.execute("DELETE FROM pools WHERE " + consts.ID + " = ?", (pool_id, )).rowcount
+            conn.execute("DELETE FROM programs WHERE " + consts.POOL_ID + " = ?", (pool_id, ))
+            conn.execute("DELETE FROM seasons WHERE " + consts.POOL_ID + " = ?", (pool_id, ))
+
+            for key in ((consts.POOLS, ), (consts.PROGRAMS, pool_id), (consts.SEASONS, pool_id)):
+                self._on_commit(lambda key=key: self._drop_snapshot(key))
+
+        if delete_count == 0:
+            return False
+
+        return True
 
 
     @staticmethod
-    def get_month_day(date_string):
-        return date_string.split('-')
+    def get_defaults():
+        defaults_file = open(os.path.join(DB_FOLDER_NAME, DEFAULT_FILE_NAME))
+        return json.load(defaults_file)
 
 
-    def get_next_program(self, now=datetime.now()):
+    def get_next_program(self, pool_id, now=None):
         '''
-        Returns the next program as StartEvent by querying the database
+        Returns the pool's next program and its start datetime by binary searching the start time index
         Currently returns the event with the next start time (could change to reschedule the current event)
+        now - defaults to the clock's current time
         '''
-        programs = self.get_all_programs()
-        next_program = None
-        next_program_timedelta = None
-        next_program_start = None
-
-        for program in programs:
-            program_start_time = datetime.strptime(program[consts.START], "%H:%M:%S")
+        if now is None:
+            now = self.clock.now()
 
-            program_start = datetime.combine(now.date(), program_start_time.time())
+        program_index = self._get_program_index(pool_id)
+        now_seconds = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1000000
 
-            if program_start_time.time() < now.time():
-                program_start += timedelta(days=1)
+        with self._cache_lock:
+            next_program, start_seconds, starts_tomorrow = program_index.next_program(now_seconds)
 
-            program_timedelta = program_start - now
+        if next_program is None:
+            return None, None
 
-            if next_program is None or next_program_timedelta > program_timedelta:
-                next_program = program
-                next_program_timedelta = program_timedelta
-                next_program_start = program_start
+        next_program_start = datetime(now.year, now.month, now.day) + timedelta(seconds=start_seconds)
+        if starts_tomorrow:
+            next_program_start += timedelta(days=1)
 
         return next_program, next_program_start
 
 
-    def get_next_event(self, now=datetime.now()):
-        # TODO: Interpolate between summer and winter duration
-        next_program, program_start = self.get_next_program(now)
-        if next_program is None:
-            return None
+    def get_next_event(self, pool_id, now=None):
+        # One pooled connection serves both the program and season queries
+        with self._pool.connection():
+            next_program, program_start = self.get_next_program(pool_id, now)
+            if next_program is None:
+                return None
+
+            duration = self.get_interpolated_duration(pool_id, program_start.date(), next_program.summer_duration, next_program.winter_duration)
+
+        return scheduler.Scheduler.StartEvent(program_start, duration, next_program.speed, pool_id, program_id=next_program.id)
+
+
+    def get_schedule(self, pool_id, start, end):
+        '''
+        Generator of every StartEvent and StopEvent the scheduler would run for the pool from start until end (datetimes)
+        Like StopEvent.invoke, the program after a stop is the next one starting at or after the stop time
+        '''
+        now = start
+
+        while True:
+            start_event = self.get_next_event(pool_id, now)
+            if start_event is None or start_event.event_time >= end:
+                return
 
-        duration = self.get_interpolated_duration(program_start.date(), next_program[consts.SUMMER_DURATION], next_program[consts.WINTER_DURATION])
+            stop_event = scheduler.Scheduler.StopEvent(start_event.event_time + start_event.duration, pool_id)
 
-        return scheduler.Scheduler.StartEvent(program_start, duration, int(next_program[consts.SPEED]))
+            yield start_event
+            yield stop_event
 
+            # A zero length program must not be found again at its own start time
+            now = max(stop_event.event_time, start_event.event_time + timedelta(microseconds=1))
 
-    def get_interpolated_duration(self, start_date, summer_duration, winter_duration):
+
+    def get_interpolated_duration(self, pool_id, start_date, summer_duration, winter_duration):
         '''
+        pool_id - pool whose seasons the duration is interpolated over
         start_date - datetime of program start date
-        summer_duration/winter_duration - H:M:S formatted string for program duration
+        summer_duration/winter_duration - program durations in seconds
         '''
-        duration_chart = self.get_duration_chart(start_date, summer_duration, winter_duration)
-        previous_event, next_event = self.get_previous_next_events(start_date, duration_chart)
+        duration_curve = self.get_duration_curve(pool_id, start_date.year, summer_duration, winter_duration)
+        return timedelta(seconds=duration_curve[start_date.timetuple().tm_yday - 1])
 
-        event_range = (next_event[1] - previous_event[1]).days
-        since_previous = (start_date - previous_event[1]).days
 
-        completion_ratio = float(since_previous) / event_range
-        duration_slope = next_event[0] - previous_event[0]
-        duration = previous_event[0] + duration_slope * completion_ratio
+    def get_duration_curve(self, pool_id, year, summer_duration, winter_duration):
+        '''
+        Returns the interpolated duration in seconds for every day of year, indexed by day of year - 1
+        Built once per program durations and season config, rebuilt after a season update
+        Pools with the same season config share curves, at most MAX_DURATION_CURVES are kept
+        '''
+        seasons = self.get_seasons(pool_id)
+        key = (year, summer_duration, winter_duration, seasons[consts.SUMMER].key(), seasons[consts.WINTER].key())
 
-        return timedelta(seconds=duration)
+        # Built under the lock, so threads asking for the same curve build it once
+        with self._curve_lock:
+            duration_curve = self._duration_curves.get(key)
+            if duration_curve is None:
+                duration_curve = self._build_duration_curve(year, summer_duration, winter_duration, seasons)
+                self._duration_curves[key] = duration_curve
+                if len(self._duration_curves) > MAX_DURATION_CURVES:
+                    self._duration_curves.popitem(last=False)
+            else:
+                self._duration_curves.move_to_end(key)
 
+        return duration_curve
 
-    def get_duration_chart(self, start_date, summer_duration, winter_duration):
+
+    def _build_duration_curve(self, year, summer_duration, winter_duration, seasons):
         '''
-        Durations passed in H:M:S string form
-        Returns list of pairs (duration in seconds, date this year)
+        Walks every day of year once, interpolating between the surrounding duration chart points
+        Gives the same values as get_previous_next_events would for each day
         '''
-        summer_duration = datetime.strptime(summer_duration, "%H:%M:%S")
-        winter_duration = datetime.strptime(winter_duration, "%H:%M:%S")
+        duration_chart = self.get_duration_chart(date(year, 1, 1), summer_duration, winter_duration, seasons)
+
+        # The chart repeated for the surrounding years, so every day has a point before and after it
+        chart_points = [(duration, chart_date.replace(year=year + year_offset))
+                        for year_offset in (-1, 0, 1)
+                        for duration, chart_date in duration_chart]
+
+        duration_curve = array('d')
+        point_index = 0
+        day = date(year, 1, 1)
+
+        while day.year == year:
+            while chart_points[point_index + 1][1] <= day:
+                point_index += 1
+
+            previous_event = chart_points[point_index]
+            next_event = chart_points[point_index + 1]
+
+            completion_ratio = float((day - previous_event[1]).days) / (next_event[1] - previous_event[1]).days
+            duration_curve.append(previous_event[0] + (next_event[0] - previous_event[0]) * completion_ratio)
 
-        summer_seconds = timedelta(hours=summer_duration.hour, minutes=summer_duration.minute, seconds=summer_duration.second).total_seconds()
-        winter_seconds = timedelta(hours=winter_duration.hour, minutes=winter_duration.minute, seconds=winter_duration.second).total_seconds()
-        halfway_seconds = abs(summer_seconds - winter_seconds)
+            day += timedelta(days=1)
 
-        seasons = self.get_season_dates()
+        return duration_curve
 
-        summer_start = datetime.strptime(seasons[consts.SUMMER][consts.START], "%m-%d").date().replace(year=start_date.year)
-        summer_peak = datetime.strptime(seasons[consts.SUMMER][consts.PEAK], "%m-%d").date().replace(year=start_date.year)
-        winter_start = datetime.strptime(seasons[consts.WINTER][consts.START], "%m-%d").date().replace(year=start_date.year)
-        winter_peak = datetime.strptime(seasons[consts.WINTER][consts.PEAK], "%m-%d").date().replace(year=start_date.year)
+
+    def get_duration_chart(self, start_date, summer_duration, winter_duration, seasons):
+        '''
+        Durations passed in seconds
+        seasons - models.Season of the pool by name, as returned by get_seasons
+        Returns list of pairs (duration in seconds, date this year)
+        '''
+        summer_seconds = float(summer_duration)
+        winter_seconds = float(winter_duration)
+        halfway_seconds = (summer_seconds + winter_seconds) / 2
+
+        summer_start = seasons[consts.SUMMER].start_date(start_date.year)
+        summer_peak = seasons[consts.SUMMER].peak_date(start_date.year)
+        winter_start = seasons[consts.WINTER].start_date(start_date.year)
+        winter_peak = seasons[consts.WINTER].peak_date(start_date.year)
 
         # At season start, the duration is 1/2 between the summer winter difference
         duration_chart = [
@@ -193,56 +525,149 @@ class Database():
         return previous_event, next_event
 
 
-    def add_program(self, speed, start, summer_duration, winter_duration):
-        conn = sqlite3.connect(self.DB_PATH)
+    def _check_overlaps(self, pool_id, program):
+        '''
+        [REQUIRES _write]
+        Raises ProgramOverlapError if the program would run into another program of the pool, or another into it,
+        on any day of the year, including runs past midnight into the next day's programs
+        Durations interpolate linearly between the season chart points, so a program runs longest at max(summer, winter)
+        Only programs starting within that reach of each other are candidates, the duration curve then finds the date
+        program - models.Program, its id is the one it replaces (None when adding)
+        '''
+        start = program.start
+        max_duration = program.max_duration
+        program_index = self._get_program_index(pool_id)
+        pending_index, removed_ids = self._pending_programs.get(pool_id, (None, ()))
+
+        with self._cache_lock:
+            longest = max(max_duration, program_index.max_duration())
+            if pending_index is not None:
+                longest = max(longest, pending_index.max_duration())
 
-        # TODO: Prevent overlapping events
+            candidates = [candidate for candidate in program_index.starting_within(start - longest, start + max_duration)
+                          if candidate[1].id not in removed_ids]
 
-        conn.execute('''INSERT INTO programs VALUES (NULL, ?, ?, ?, ?)''',
-                       (speed,
-                        start,
-                        summer_duration,
-                        winter_duration))
-        conn.commit()
-        conn.close()
+        if pending_index is not None:
+            candidates.extend(pending_index.starting_within(start - longest, start + max_duration))
 
+        for other_start, other in candidates:
+            # Its own old version, or a start the unique constraint rejects
+            if other.id == program.id or other_start == start:
+                continue
 
-    def get_all_programs(self):
-        conn = sqlite3.connect(self.DB_PATH)
-        cur = conn.cursor()
-        cur.execute('''SELECT * FROM programs ORDER BY start''')
-        programs = cur.fetchall()
-        conn.close()
+            gap_after = (other_start - start) % SECONDS_PER_DAY
+            gap_before = (start - other_start) % SECONDS_PER_DAY
 
-        return [
-            {
-                consts.ID : program[0],
-                consts.SPEED : program[1],
-                consts.START : program[2],
-                consts.SUMMER_DURATION : program[3],
-                consts.WINTER_DURATION : program[4]
-            }
+            if max_duration > gap_after:
+                overlap_date = self._find_overlap_date(pool_id, program, gap_after)
+            elif other.max_duration > gap_before:
+                overlap_date = self._find_overlap_date(pool_id, other, gap_before)
+            else:
+                continue
 
-            for program in programs
-        ]
+            if overlap_date is not None:
+                raise ProgramOverlapError(other, overlap_date)
+
+
+    def _find_overlap_date(self, pool_id, program, gap_seconds):
+        '''
+        Returns the first date from today that the program runs longer than gap_seconds, None if it never does
+        '''
+        today = self.clock.now().date()
+
+        for year in (today.year, today.year + 1):
+            duration_curve = self.get_duration_curve(pool_id, year, program.summer_duration, program.winter_duration)
+            first_day = today.timetuple().tm_yday - 1 if year == today.year else 0
+
+            for day in range(first_day, len(duration_curve)):
+                if duration_curve[day] > gap_seconds:
+                    return date(year, 1, 1) + timedelta(days=day)
+
+        return None
+
+
+    def add_program(self, program):
+        '''
+        program - models.Program without an id
+        Returns it as stored, with its id, raises ProgramOverlapError if the program would overlap another
+        '''
+        with self._write() as conn:
+            self._check_overlaps(program.pool_id, program)
+
+            program_id = conn.execute('''INSERT INTO programs VALUES (NULL, ?, ?, ?, ?, ?)''',
+                                        (program.pool_id,
+                                         program.speed,
+                                         program.start,
+                                         program.summer_duration,
+                                         program.winter_duration)).lastrowid
+
+            program = Program(program_id, program.pool_id, program.speed, program.start, program.summer_duration, program.winter_duration)
+            self._pending_add(program)
+            self._on_commit(lambda: self._index_add(program))
+
+        return program
+
+
+    def get_all_programs(self, pool_id):
+        '''
+        Returns the pool's models.Program objects ordered by start time
+        '''
+        return list(self._get_programs_snapshot(pool_id))
+
+
+    def get_programs_page(self, pool_id, after=None, limit=None):
+        '''
+        Returns up to limit of the pool's models.Program objects ordered by start and id that come after the (start, id) key after
+        Only the page is copied out of the cached index
+        '''
+        program_index = self._get_program_index(pool_id)
+        with self._cache_lock:
+            return program_index.page(after, limit)
+
+
+    def _get_programs_snapshot(self, pool_id):
+        program_index = self._get_program_index(pool_id)
+        with self._cache_lock:
+            return program_index.programs()
+
+
+    def _get_program_index(self, pool_id):
+        return self._get_snapshot((consts.PROGRAMS, pool_id), lambda: self._load_program_index(pool_id))
+
+
+    def _load_program_index(self, pool_id):
+        with self._pool.committed_connection() as conn:
+            programs = conn.execute(PROGRAM_SELECT + " WHERE " + consts.POOL_ID + " = ? ORDER BY start", (pool_id, )).fetchall()
+
+        return ProgramIndex.from_sorted(Program.from_row(program) for program in programs)
+
+
+    def _select_program(self, conn, program_id):
+        row = conn.execute(PROGRAM_SELECT + " WHERE " + consts.ID + " = ?", (program_id, )).fetchone()
+        if row is None:
+            return None
+        return Program.from_row(row)
 
     
-    def delete_program(self, program_id):
-        conn = sqlite3.connect(self.DB_PATH)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM programs WHERE " + consts.ID + " = ?", (program_id, ))
-        delete_count = cur.rowcount
-        conn.commit()
-        conn.close()
+    def delete_program(self, pool_id, program_id):
+        with self._write() as conn:
+            delete_count = conn.execute("DELETE FROM programs WHERE " + consts.ID + " = ? AND " + consts.POOL_ID + " = ?",
+                                        (program_id, pool_id)).rowcount
+
+            if delete_count != 0:
+                self._pending_remove(pool_id, program_id)
+                self._on_commit(lambda: self._index_remove(pool_id, program_id))
 
         if delete_count == 0:
             return False
 
         return True
 
-    def update_program(self, program_id, speed=None, start=None, summer_duration=None, winter_duration=None):
+    def update_program(self, pool_id, program_id, speed=None, start=None, summer_duration=None, winter_duration=None):
         '''
-        At least one value must be updated
+        At least one value must be updated, times in seconds
+        Returns the updated models.Program, or None if program_id is not a program of the pool
+        Raises ProgramOverlapError if the new times would overlap another program
         '''
 
         if speed is None and start is None and summer_duration is None and winter_duration is None:
@@ -270,43 +695,111 @@ class Database():
         # Remove final ", "
         update_string = update_string[0:-2]
 
-        update_string += " WHERE " + consts.ID + " = ?"
-        update_arguments.append(program_id)
+        update_string += " WHERE " + consts.ID + " = ? AND " + consts.POOL_ID + " = ?"
+        update_arguments.extend((program_id, pool_id))
 
-        conn = sqlite3.connect(self.DB_PATH)
-        cur = conn.cursor()
+        with self._write() as conn:
+            current = self._select_program(conn, program_id)
 
-        cur.execute(update_string, update_arguments)
+            # A speed change cannot create an overlap, so it is not blocked by one that already exists
+            if current is not None and current.pool_id == pool_id and \
+                    (start is not None or summer_duration is not None or winter_duration is not None):
+                self._check_overlaps(pool_id, current.replace(start=start, summer_duration=summer_duration, winter_duration=winter_duration))
 
-        update_count = cur.rowcount
-        conn.commit()
-        conn.close()
+            update_count = conn.execute(update_string, update_arguments).rowcount
 
-        if update_count == 0:
-            return False
+            if update_count == 0:
+                return None
 
-        return True
+            program = current.replace(speed, start, summer_duration, winter_duration)
+            self._pending_remove(pool_id, program_id)
+            self._pending_add(program)
+            self._on_commit(lambda: (self._index_remove(pool_id, program_id), self._index_add(program)))
 
+        return program
 
-    def get_season_dates(self):
-        conn = sqlite3.connect(self.DB_PATH)
-        cur = conn.cursor()
-        cur.execute('''SELECT * FROM seasons''')
 
-        seasons = {}
+    def apply_program_batch(self, pool_id, adds=(), updates=(), deletes=()):
+        '''
+        Applies deletes, then updates, then adds to the pool in one transaction so the batch commits atomically
+        adds - models.Program objects of the pool without ids
+        updates - dicts of id and any of speed, start, summer_duration, winter_duration, times in seconds
+        deletes - program ids
+        Returns the updated and added models.Program objects as stored
+        Raises ProgramBatchError listing every failed item
+        '''
+        errors = []
+        written = []
+
+        def add_error(action, index, message, **details):
+            errors.append(dict({consts.ACTION: action, consts.INDEX: index, "message": message}, **details))
+
+        def add_overlap_error(action, index, error):
+            add_error(action, index, str(error), **{consts.PROGRAM: error.program.to_dict(), consts.DATE: error.overlap_date.isoformat()})
+
+        with self._write():
+            for index, program_id in enumerate(deletes):
+                if not self.delete_program(pool_id, program_id):
+                    add_error(consts.DELETE, index, "Passed id was not valid")
+
+            for index, program in enumerate(updates):
+                try:
+                    updated = self.update_program(pool_id,
+                                                  program[consts.ID],
+                                                  program.get(consts.SPEED),
+                                                  program.get(consts.START),
+                                                  program.get(consts.SUMMER_DURATION),
+                                                  program.get(consts.WINTER_DURATION))
+                    if updated is None:
+                        add_error(consts.UPDATE, index, "Passed id was not valid")
+                    else:
+                        written.append(updated)
+                except sqlite3.IntegrityError:
+                    add_error(consts.UPDATE, index, "Start times must be unique")
+                except ProgramOverlapError as e:
+                    add_overlap_error(consts.UPDATE, index, e)
+
+            for index, program in enumerate(adds):
+                try:
+                    written.append(self.add_program(program))
+                except sqlite3.IntegrityError:
+                    add_error(consts.ADD, index, "Start times must be unique")
+                except ProgramOverlapError as e:
+                    add_overlap_error(consts.ADD, index, e)
+
+            if errors:
+                # Rolls back the whole batch
+                raise ProgramBatchError(errors)
+
+        return written
+
+
+    def get_season_dates(self, pool_id):
+        '''
+        Returns the pool's seasons in their API form, {season: {start: M-D, peak: M-D}}
+        '''
+        return {name: season.to_dict() for name, season in self.get_seasons(pool_id).items()}
 
-        for season in cur.fetchall():
-            season_dict = {}
-            season_dict[consts.START] = str(season[1]) + "-" + str(season[2])
-            season_dict[consts.PEAK] = str(season[3]) + "-" + str(season[4])
-            seasons[season[0]] = season_dict
 
-        conn.close()
+    def get_seasons(self, pool_id):
+        '''
+        Returns the pool's models.Season objects by name, read only
+        '''
+        return self._get_snapshot((consts.SEASONS, pool_id), lambda: self._load_seasons(pool_id))
 
-        return seasons
 
+    def _load_seasons(self, pool_id):
+        with self._pool.committed_connection() as conn:
+            rows = conn.execute('''SELECT season, start_month, start_day, peak_month, peak_day FROM seasons WHERE pool_id = ?''',
+                                (pool_id, )).fetchall()
 
-    def update_season(self, season, start=None, peak=None):
+        return MappingProxyType({season[0]: Season.from_row(season) for season in rows})
+
+
+    def update_season(self, pool_id, season, start=None, peak=None):
+        '''
+        start/peak - (month, day) as returned by models.parse_month_day
+        '''
         if start is None and peak is None:
             raise ValueError("Database update_season must be passed some value to update")
 
@@ -316,30 +809,148 @@ class Database():
         if start is not None:
             update_string += consts.START_MONTH + " = ?, "
             update_string += consts.START_DAY + " = ?, "
-            update_arguments.extend(self.get_month_day(start))
+            update_arguments.extend(start)
 
         if peak is not None:
             update_string += consts.PEAK_MONTH + " = ?, "
             update_string += consts.PEAK_DAY + " = ?, "
-            update_arguments.extend(self.get_month_day(peak))
+            update_arguments.extend(peak)
 
         # Remove final ", "
         update_string = update_string[0:-2]
 
-        update_string += " WHERE " + consts.SEASON + " = ?"
-        update_arguments.append(season)
-
-        conn = sqlite3.connect(self.DB_PATH)
-        cur = conn.cursor()
+        update_string += " WHERE " + consts.POOL_ID + " = ? AND " + consts.SEASON + " = ?"
+        update_arguments.extend((pool_id, season))
 
-        cur.execute(update_string, update_arguments)
+        with self._write() as conn:
+            update_count = conn.execute(update_string, update_arguments).rowcount
+            self._on_commit(lambda: self._drop_snapshot((consts.SEASONS, pool_id)))
 
-        update_count = cur.rowcount
-        conn.commit()
-        conn.close()
+        # Curves for the old season config can never be looked up again
+        with self._curve_lock:
+            self._duration_curves.clear()
 
         if update_count == 0:
             return False
 
         return True
 
+
+    def get_last_runs(self):
+        '''
+        Returns pool id -> (timestamp, speed, source) of each pool's latest logged speed change
+        '''
+        with self._pool.committed_connection() as conn:
+            rows = conn.execute('''SELECT pool_id, time, speed, source FROM runs
+                                   WHERE id IN (SELECT MAX(id) FROM runs GROUP BY pool_id)''').fetchall()
+
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+
+    def append_runs(self, runs, daily, monthly):
+        '''
+        Appends speed changes to the run log and adds runtime to the rollups in one transaction
+        runs - (pool id, timestamp, speed, source)
+        daily/monthly - {(pool id, YYYY-MM-DD or YYYY-MM, source): (runtime seconds, speed hours)}
+        '''
+        with self._pool.transaction() as conn:
+            conn.executemany('''INSERT INTO runs VALUES (NULL, ?, ?, ?, ?)''', runs)
+
+            for table_name, period, rollup in (("daily_runtime", consts.DAY, daily), ("monthly_runtime", consts.MONTH, monthly)):
+                conn.executemany("INSERT INTO " + table_name + " VALUES (?, ?, ?, ?, ?) "
+                                 "ON CONFLICT (" + consts.POOL_ID + ", " + period + ", " + consts.SOURCE + ") DO UPDATE SET "
+                                 + consts.RUNTIME_SECONDS + " = " + consts.RUNTIME_SECONDS + " + excluded." + consts.RUNTIME_SECONDS + ", "
+                                 + consts.SPEED_HOURS + " = " + consts.SPEED_HOURS + " + excluded." + consts.SPEED_HOURS,
+                                 [key + tuple(totals) for key, totals in rollup.items()])
+
+
+    def get_runtime_rollups(self, pool_id, period, first, last):
+        '''
+        Returns the pool's runtime and speed hours per day or month and source, from first through last
+        period - consts.DAY or consts.MONTH
+        first/last - YYYY-MM-DD or YYYY-MM strings matching the period
+        '''
+        table_name = "daily_runtime" if period == consts.DAY else "monthly_runtime"
+
+        with self._pool.committed_connection() as conn:
+            rows = conn.execute("SELECT " + period + ", " + consts.SOURCE + ", " + consts.RUNTIME_SECONDS + ", " + consts.SPEED_HOURS
+                                + " FROM " + table_name + " WHERE " + consts.POOL_ID + " = ? AND " + period + " BETWEEN ? AND ?"
+                                + " ORDER BY " + period + ", " + consts.SOURCE,
+                                (pool_id, first, last)).fetchall()
+
+        return [{period: row[0], consts.SOURCE: row[1], consts.RUNTIME_SECONDS: row[2], consts.SPEED_HOURS: row[3]} for row in rows]
+
+
+    def get_scheduler_states(self):
+        '''
+        Returns pool id -> (current event dict, next event dict) as last checkpointed, either may be None
+        '''
+        with self._pool.committed_connection() as conn:
+            rows = conn.execute('''SELECT pool_id, current_event, next_event FROM scheduler_state''').fetchall()
+
+        return {row[0]: tuple(None if event is None else json.loads(event) for event in row[1:]) for row in rows}
+
+
+    def save_scheduler_states(self, states):
+        '''
+        Replaces the checkpoint of each pool in states in one transaction
+        states - {pool id: (current event dict, next event dict)}, None deletes the pool's checkpoint
+        '''
+        saved = [(pool_id, ) + tuple(None if event is None else json.dumps(event) for event in state)
+                 for pool_id, state in states.items() if state is not None]
+        removed = [(pool_id, ) for pool_id, state in states.items() if state is None]
+
+        with self._pool.transaction() as conn:
+            conn.executemany('''INSERT OR REPLACE INTO scheduler_state VALUES (?, ?, ?)''', saved)
+            conn.executemany('''DELETE FROM scheduler_state WHERE pool_id = ?''', removed)
+
+
+    def append_telemetry(self, samples, rollups):
+        '''
+        Inserts telemetry samples and merges them into the rollups in one transaction
+        samples - (pool id, timestamp, then each of consts.TELEMETRY_METRICS or None)
+        rollups - {(pool id, resolution seconds, metric, bucket timestamp): (count, total, minimum, maximum)}
+        '''
+        with self._pool.transaction() as conn:
+            conn.executemany("INSERT INTO telemetry VALUES (?, ?, " + ", ".join("?" for _ in consts.TELEMETRY_METRICS) + ")", samples)
+            conn.executemany("INSERT INTO telemetry_rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT (" + consts.POOL_ID + ", " + consts.RESOLUTION + ", " + consts.METRIC + ", " + consts.BUCKET + ") DO UPDATE SET "
+                             + consts.COUNT + " = " + consts.COUNT + " + excluded." + consts.COUNT + ", "
+                             + consts.TOTAL + " = " + consts.TOTAL + " + excluded." + consts.TOTAL + ", "
+                             + consts.MINIMUM + " = min(" + consts.MINIMUM + ", excluded." + consts.MINIMUM + "), "
+                             + consts.MAXIMUM + " = max(" + consts.MAXIMUM + ", excluded." + consts.MAXIMUM + ")",
+                             [key + tuple(totals) for key, totals in rollups.items()])
+
+
+    def get_telemetry_rollups(self, pool_id, resolution, metrics, first, last):
+        '''
+        Returns (metric, bucket timestamp, count, total, minimum, maximum) of the pool's buckets from first through last
+        ordered by metric and bucket
+        '''
+        with self._pool.committed_connection() as conn:
+            return conn.execute("SELECT " + ", ".join((consts.METRIC, consts.BUCKET, consts.COUNT, consts.TOTAL, consts.MINIMUM, consts.MAXIMUM))
+                                + " FROM telemetry_rollups WHERE " + consts.POOL_ID + " = ? AND " + consts.RESOLUTION + " = ?"
+                                + " AND " + consts.METRIC + " IN (" + ", ".join("?" for _ in metrics) + ")"
+                                + " AND " + consts.BUCKET + " BETWEEN ? AND ? ORDER BY " + consts.METRIC + ", " + consts.BUCKET,
+                                (pool_id, resolution, *metrics, first, last)).fetchall()
+
+
+    def get_telemetry_samples(self, pool_id, first, last, limit):
+        '''
+        Returns up to limit (timestamp, then each of consts.TELEMETRY_METRICS) of the pool from first through last, oldest first
+        '''
+        with self._pool.committed_connection() as conn:
+            return conn.execute("SELECT " + ", ".join((consts.TIME, ) + consts.TELEMETRY_METRICS) + " FROM telemetry"
+                                + " WHERE " + consts.TIME + " BETWEEN ? AND ? AND " + consts.POOL_ID + " = ?"
+                                + " ORDER BY " + consts.TIME + " LIMIT ?",
+                                (first, last, pool_id, limit)).fetchall()
+
+
+    def prune_telemetry(self, samples_before, rollups_before):
+        '''
+        Deletes samples older than samples_before and rollups of each resolution older than rollups_before[resolution]
+        '''
+        with self._pool.transaction() as conn:
+            conn.execute("DELETE FROM telemetry WHERE " + consts.TIME + " < ?", (samples_before, ))
+            conn.executemany("DELETE FROM telemetry_rollups WHERE " + consts.RESOLUTION + " = ? AND " + consts.BUCKET + " < ?",
+                             list(rollups_before.items()))
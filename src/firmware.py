@@ -1,4 +1,36 @@
 from datetime import datetime
+import random
+import time
 
-def set_speed(speed):
-    print("%s - Current Speed: %d" % (datetime.now(), speed))
\ No newline at end of file
+def set_speed(speed, controller_id, timeout=None):
+    '''
+    Sets the pump driven by controller_id to speed, 0 turns it off
+    Returns True once the controller has acknowledged the speed
+    '''
+    print("%s - Controller %d Speed: %d" % (datetime.now(), controller_id, speed))
+    return True
+
+
+class SimulatedFirmware():
+    '''
+    Stand-in for slow pump I/O when testing
+    Every command takes delay seconds to acknowledge, failure_rate of them fail outright
+    A command slower than its timeout raises TimeoutError once the timeout has passed
+    '''
+
+    def __init__(self, delay, failure_rate=0.0):
+        self.delay = delay
+        self.failure_rate = failure_rate
+
+
+    def set_speed(self, speed, controller_id, timeout=None):
+        if timeout is not None and self.delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("Controller %d did not acknowledge speed %d within %.3f s" % (controller_id, speed, timeout))
+
+        time.sleep(self.delay)
+
+        if random.random() < self.failure_rate:
+            raise IOError("Controller %d rejected speed %d" % (controller_id, speed))
+
+        return set_speed(speed, controller_id)
@@ -0,0 +1,92 @@
+import collections
+from clock import Clock
+from writebehind import WriteBehindBuffer
+from datetime import datetime, timedelta
+
+# Longest a speed change waits in memory before it is written
+FLUSH_INTERVAL_SECONDS = 5.0
+# Buffered speed changes that trigger an early write
+MAX_BUFFERED_RUNS = 256
+
+
+class RunHistory():
+    '''
+    Write-behind run log, the scheduler only appends to a buffer while it holds its lock
+    A flusher thread writes the buffered speed changes and their runtime rollups in one transaction
+    A run lasts from a speed change until the pool's next one, its runtime is split at local midnight
+    '''
+
+    def __init__(self, database, clock=None):
+        self.database = database
+        self.clock = clock if clock is not None else Clock()
+
+        # pool id -> (timestamp, speed, source) of its latest speed change, closed by the next one
+        # Seeded from the log, so a run that was open when the service stopped is counted once it ends
+        # Only the flusher writing runs, serialized by the buffer, reads or replaces it
+        self._open_runs = database.get_last_runs()
+
+        # (pool id, timestamp, speed, source) not yet written
+        self._runs = WriteBehindBuffer(self._write, "run history", FLUSH_INTERVAL_SECONDS, MAX_BUFFERED_RUNS)
+
+
+    def record(self, pool_id, speed, source, timestamp=None):
+        '''
+        Buffers a speed change
+        '''
+        self._runs.add([(pool_id, self.clock.time() if timestamp is None else timestamp, speed, source)])
+
+
+    def flush(self):
+        '''
+        Writes every speed change buffered so far, returns once it is committed
+        '''
+        self._runs.flush()
+
+
+    def get_last_run(self, pool_id):
+        '''
+        Returns (timestamp, speed, source) of the pool's latest written speed change, or None
+        Changes still buffered are not included
+        '''
+        return self._open_runs.get(pool_id)
+
+
+    def _write(self, runs):
+        '''
+        Closes the open runs the speed changes end, kept only once the changes and their rollups are committed
+        '''
+        open_runs = dict(self._open_runs)
+        daily = collections.defaultdict(lambda: [0.0, 0.0])
+        monthly = collections.defaultdict(lambda: [0.0, 0.0])
+
+        for pool_id, timestamp, speed, source in runs:
+            open_run = open_runs.get(pool_id)
+            if open_run is not None and open_run[1] > 0:
+                add_runtime(daily, monthly, pool_id, open_run[0], timestamp, open_run[1], open_run[2])
+            open_runs[pool_id] = (timestamp, speed, source)
+
+        self.database.append_runs(runs, daily, monthly)
+        self._open_runs = open_runs
+
+
+def add_runtime(daily, monthly, pool_id, start_timestamp, end_timestamp, speed, source):
+    '''
+    Adds a run's seconds and speed hours to the day and month rollups it falls in, splitting it at local midnight
+    daily/monthly - {(pool id, YYYY-MM-DD or YYYY-MM, source): [runtime seconds, speed hours]}
+    '''
+    segment_start = start_timestamp
+
+    while segment_start < end_timestamp:
+        start = datetime.fromtimestamp(segment_start)
+        next_midnight = datetime(start.year, start.month, start.day) + timedelta(days=1)
+        segment_end = min(end_timestamp, next_midnight.timestamp())
+
+        seconds = segment_end - segment_start
+        speed_hours = speed * seconds / 3600
+
+        for rollup, period in ((daily, start.strftime("%Y-%m-%d")), (monthly, start.strftime("%Y-%m"))):
+            totals = rollup[(pool_id, period, source)]
+            totals[0] += seconds
+            totals[1] += speed_hours
+
+        segment_start = segment_end
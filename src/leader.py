@@ -0,0 +1,265 @@
+'''
+Runs the scheduler in exactly one process when the API is served by several workers
+Every worker builds the app, the first to take an exclusive flock on the lock file beside the database leads:
+it runs the Scheduler, and with it the firmware, and serves the other workers' calls over a Unix socket
+Followers answer reads from the shared database and forward every change the scheduler acts on to the leader
+The kernel releases the lock however the leader exits, a follower blocked on it then takes over,
+resuming from the checkpointed scheduler state
+
+Workers must build the app after they fork (no gunicorn --preload), a lock taken before the fork would be shared
+'''
+import fcntl
+import os
+import secrets
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from broadcast import Broadcaster
+from clock import Clock
+import scheduler
+
+LOCK_FILE_SUFFIX = "-leader"
+SOCKET_FILE_SUFFIX = "-leader.sock"
+
+# How long a follower keeps retrying a call while the leader is down or still taking over
+LEADER_WAIT_SECONDS = 10
+LEADER_RETRY_SECONDS = 0.1
+
+# Seconds between reads of the shared state while a follower has streams open
+STATE_POLL_SECONDS = 1
+
+# Scheduler methods a follower may call, those that change state run under the leader's scheduler lock
+LOCKED_CALLS = {"add_pool", "remove_pool", "programs_changed", "seasons_changed", "override_current_event"}
+UNLOCKED_CALLS = {"get_jitter", "get_reschedule_stats", "actuator.get_stats", "history.flush"}
+
+
+class LeaderUnavailableError(Exception):
+    '''
+    Raised in a follower when no leader answered within LEADER_WAIT_SECONDS
+    '''
+
+
+class LeaderCallError(Exception):
+    '''
+    Raised in a follower when the call raised in the leader, with its message
+    '''
+
+
+class LeaderElection():
+    '''
+    The lock file also holds the current leader's authentication key, so only workers that can read it may call it
+    '''
+
+    def __init__(self, db_path):
+        self.lock_path = db_path + LOCK_FILE_SUFFIX
+        self.address = db_path + SOCKET_FILE_SUFFIX
+        self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._listener = None
+
+
+    def try_lead(self):
+        '''
+        Returns True if this process took the lock and is now the leader
+        '''
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+
+    def follow(self, on_elected):
+        '''
+        Waits for the lock on a background thread, then calls on_elected() on it
+        '''
+        def wait_for_lock():
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            on_elected()
+
+        threading.Thread(target=wait_for_lock, daemon=True).start()
+
+
+    def serve(self, leader_scheduler):
+        '''
+        [REQUIRES LEADING]
+        Starts answering followers' calls on leader_scheduler
+        '''
+        authkey = secrets.token_hex(32).encode()
+
+        # A leader that died left its socket behind, nobody else can be serving while the lock is held
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listener = Listener(self.address, "AF_UNIX", authkey=authkey)
+
+        os.ftruncate(self._lock_fd, 0)
+        os.pwrite(self._lock_fd, authkey, 0)
+
+        threading.Thread(target=self._accept, args=(leader_scheduler, ), daemon=True).start()
+        print("Leading the scheduler on %s" % (self.address, ))
+
+
+    def _accept(self, leader_scheduler):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                print("Rejected follower connection: %s" % (str(e), ))
+                continue
+
+            threading.Thread(target=self._answer, args=(leader_scheduler, conn), daemon=True).start()
+
+
+    @staticmethod
+    def _answer(leader_scheduler, conn):
+        '''
+        Answers one (name, args) call with (True, result) or (False, message)
+        '''
+        with conn:
+            try:
+                name, args = conn.recv()
+            except EOFError:
+                return
+
+            try:
+                if name not in LOCKED_CALLS and name not in UNLOCKED_CALLS:
+                    raise ValueError("%s cannot be called on the leader" % (name, ))
+
+                target = leader_scheduler
+                for attribute in name.split("."):
+                    target = getattr(target, attribute)
+
+                if name in LOCKED_CALLS:
+                    with leader_scheduler:
+                        result = target(*args)
+                else:
+                    result = target(*args)
+
+                reply = (True, result)
+            except Exception as e:
+                reply = (False, "%s: %s" % (type(e).__name__, str(e)))
+
+            conn.send(reply)
+
+
+    def call(self, name, *args):
+        '''
+        Calls the leader's scheduler, retrying until LEADER_WAIT_SECONDS pass without one answering
+        A call the leader had already run before it died may run again on the next, every call is safe to repeat
+        '''
+        deadline = time.monotonic() + LEADER_WAIT_SECONDS
+
+        while True:
+            try:
+                authkey = os.pread(self._lock_fd, 64, 0)
+                with Client(self.address, "AF_UNIX", authkey=authkey) as conn:
+                    conn.send((name, args))
+                    succeeded, result = conn.recv()
+                break
+            except (OSError, EOFError, AuthenticationError) as e:
+                if time.monotonic() >= deadline:
+                    raise LeaderUnavailableError("No scheduler leader answered: %s" % (str(e), ))
+                time.sleep(LEADER_RETRY_SECONDS)
+
+        if not succeeded:
+            raise LeaderCallError(result)
+        return result
+
+
+class FollowerScheduler():
+    '''
+    Stands in for the Scheduler in a worker that is not the leader, with the interface the routes use
+    Pool state is read from the leader's checkpoint in the database, changes are forwarded to the leader
+    '''
+
+    def __init__(self, database, election):
+        self.database = database
+        self.election = election
+        self.clock = Clock()
+        # Streams opened here are fed from the shared state, and handed to this worker's Scheduler if it takes over
+        self.broadcaster = Broadcaster()
+        self.actuator = FollowerScheduler.Remote(election, "actuator")
+        self.history = FollowerScheduler.Remote(election, "history")
+
+        self._stopped = threading.Event()
+        threading.Thread(target=self._poll_states, daemon=True).start()
+
+
+    def stop(self):
+        self._stopped.set()
+
+
+    def __enter__(self):
+        # The leader takes its own lock for each forwarded call
+        pass
+
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+    def add_pool(self, pool_id, controller_id):
+        self.election.call("add_pool", pool_id, controller_id)
+
+
+    def remove_pool(self, pool_id):
+        self.election.call("remove_pool", pool_id)
+
+
+    def programs_changed(self, pool_id, programs=(), deleted_ids=()):
+        self.election.call("programs_changed", pool_id, list(programs), list(deleted_ids))
+
+
+    def seasons_changed(self, pool_id):
+        self.election.call("seasons_changed", pool_id)
+
+
+    def override_current_event(self, event):
+        self.election.call("override_current_event", event)
+
+
+    def get_jitter(self):
+        return self.election.call("get_jitter")
+
+
+    def get_reschedule_stats(self):
+        return self.election.call("get_reschedule_stats")
+
+
+    def get_current_event(self, pool_id):
+        '''
+        As last checkpointed by the leader, a pool it has not checkpointed yet reads as off
+        '''
+        state = self.database.get_scheduler_states().get(pool_id) or (None, None)
+        return scheduler.Scheduler.describe(*[scheduler.Scheduler.ProgramEvent.from_dict(event) for event in state])
+
+
+    def _poll_states(self):
+        while not self._stopped.wait(STATE_POLL_SECONDS):
+            if not self.broadcaster.get_stats()["subscribers"]:
+                continue
+
+            try:
+                states = self.database.get_scheduler_states()
+            except Exception as e:
+                print("Failed to read the scheduler state for streams: %s" % (str(e), ))
+                continue
+
+            for pool_id, state in states.items():
+                # publish drops a state that did not change
+                if self.broadcaster.has_subscribers(pool_id):
+                    events = [scheduler.Scheduler.ProgramEvent.from_dict(event) for event in state]
+                    self.broadcaster.publish(pool_id, scheduler.Scheduler.describe(*events))
+
+
+    class Remote():
+        '''
+        Forwards method calls on a Scheduler attribute, the actuator or run history, to the leader's
+        '''
+        def __init__(self, election, attribute):
+            self._election = election
+            self._attribute = attribute
+
+
+        def __getattr__(self, name):
+            return lambda *args: self._election.call(self._attribute + "." + name, *args)
@@ -0,0 +1,366 @@
+'''
+Load generator replaying a request mix against the API with concurrent clients
+Runs against the Flask test client on a scratch copy of a database, or against a running server with --url,
+and reports throughput, latency percentiles and error rates per route plus how long requests waited on the scheduler lock
+
+The mix is JSON lines of {"method", "path", "body" (optional JSON), "weight" (optional, default 1)}
+Paths may use {pool}, {program_id} (a random program of the pool) and {speed} (0-3), filled in per request
+Requests are drawn by weight, or sent in file order with --replay, so a recorded log can be converted line for line
+
+Run from the repository root:
+    python src/loadgen.py --clients 8 --rate 500 --duration 10
+    python src/loadgen.py --mix recorded.jsonl --replay --url http://127.0.0.1:5000 --output load.json
+'''
+import argparse
+import contextlib
+import http.client
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+# Requests go to a scratch copy, the app must not open the production database and start its scheduler on import
+os.environ["FLASK_ENV"] = "development"
+os.environ.pop("WERKZEUG_RUN_MAIN", None)
+
+import app as app_module
+import consts
+import firmware
+from actuator import Actuator
+from database import Database
+from scheduler import Scheduler
+from simulate import copy_database
+from telemetry import Telemetry
+
+# Bursts of /program/now polls from the app, with the occasional change made while they run
+DEFAULT_MIX = [
+    {"method": "GET", "path": "/program/now?pool={pool}", "weight": 80},
+    {"method": "GET", "path": "/program/all?pool={pool}", "weight": 5},
+    {"method": "GET", "path": "/seasons/?pool={pool}", "weight": 5},
+    {"method": "PUT", "path": "/override?pool={pool}&speed={speed}&duration=00:05:00", "weight": 5},
+    {"method": "PUT", "path": "/program/update?pool={pool}&id={program_id}&speed={speed}", "weight": 5},
+]
+
+# Fixed so every run sends the same requests
+RANDOM_SEED = 7
+MAX_SPEED = 3
+
+LOCK_WAIT_METRIC = "poolfilter_scheduler_lock_wait_seconds"
+LOCK_HOLD_METRIC = "poolfilter_scheduler_lock_hold_seconds"
+METRIC_LINE = re.compile(r'^(\w+?)_(sum|count)(\{[^}]*\})? (\S+)$')
+
+
+def load_mix(path):
+    with open(path) as mix_file:
+        return [json.loads(line) for line in mix_file if line.strip()]
+
+
+def route_name(request):
+    '''
+    Method and path without the query, requests are reported per route
+    '''
+    return "%s %s" % (request["method"], request["path"].split("?")[0])
+
+
+class TestClientTarget():
+    '''
+    Sends requests through the Flask test client, one per client thread
+    '''
+
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+
+    def request(self, method, path, body=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+
+        response = client.open(path, method=method, json=body)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpTarget():
+    '''
+    Sends requests to a running server, each client thread keeps its own connection alive
+    '''
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self._host = parsed.hostname
+        self._port = parsed.port or 80
+        self._prefix = parsed.path.rstrip("/")
+        self._local = threading.local()
+
+
+    def request(self, method, path, body=None):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self._host, self._port, timeout=30)
+
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        try:
+            conn.request(method, self._prefix + path, body, headers)
+            response = conn.getresponse()
+            return response.status, response.read().decode()
+        except Exception:
+            # The next request reconnects
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+def read_lock_metrics(target):
+    '''
+    Returns {(metric, labels): (sum, count)} for the scheduler lock histograms
+    '''
+    status, text = target.request("GET", "/metrics")
+    if status != 200:
+        return {}
+
+    totals = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match is None or match.group(1) not in (LOCK_WAIT_METRIC, LOCK_HOLD_METRIC):
+            continue
+        name, field, labels, value = match.groups()
+        total_sum, total_count = totals.get((name, labels or ""), (0.0, 0))
+        if field == "sum":
+            totals[(name, labels or "")] = (float(value), total_count)
+        else:
+            totals[(name, labels or "")] = (total_sum, int(float(value)))
+    return totals
+
+
+def lock_contention(before, after):
+    '''
+    Mean and total scheduler lock wait and hold during the run, in milliseconds
+    '''
+    contention = {}
+    for key, (after_sum, after_count) in sorted(after.items()):
+        before_sum, before_count = before.get(key, (0.0, 0))
+        count = after_count - before_count
+        if count <= 0:
+            continue
+        name, labels = key
+        contention[name + labels] = {
+            "count": count,
+            "total_ms": (after_sum - before_sum) * 1000,
+            "mean_ms": (after_sum - before_sum) * 1000 / count
+        }
+    return contention
+
+
+def summarize(latencies, statuses, failures, seconds):
+    latencies = sorted(latencies)
+    count = len(latencies) + failures
+    errors = sum(number for status, number in statuses.items() if status >= 400) + failures
+
+    summary = {
+        "requests": count,
+        "throughput_rps": count / seconds if seconds else 0.0,
+        "errors": errors,
+        "error_rate": errors / count if count else 0.0,
+        "failures": failures,
+        "statuses": {str(status): number for status, number in sorted(statuses.items())}
+    }
+
+    if latencies:
+        summary.update({
+            "mean_ms": sum(latencies) / len(latencies),
+            "p50_ms": latencies[len(latencies) // 2],
+            "p90_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))],
+            "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+            "max_ms": latencies[-1]
+        })
+    return summary
+
+
+class LoadRun():
+    '''
+    Clients take request numbers from a shared counter, with a rate request n is due at start + n / rate
+    Latency counts from when a request was due rather than sent, a server that falls behind is not hidden by
+    clients that slowed down with it, without a rate every client sends as soon as its last request returned
+    '''
+
+    def __init__(self, target, mix, replay, clients, rate, duration, max_requests, pool_id, program_ids):
+        self.target = target
+        self.mix = mix
+        self.replay = replay
+        self.clients = clients
+        self.rate = rate
+        self.duration = duration
+        self.max_requests = max_requests
+        self.pool_id = pool_id
+        self.program_ids = program_ids or [0]
+        self._weights = [request.get("weight", 1) for request in mix]
+
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # route -> ([latency ms], {status: count}, failures)
+        self._results = {}
+
+
+    def _pick(self, n, rng):
+        if self.replay:
+            request = self.mix[n % len(self.mix)]
+        else:
+            request = rng.choices(self.mix, weights=self._weights)[0]
+
+        path = request["path"].format(pool=self.pool_id, program_id=rng.choice(self.program_ids), speed=rng.randint(0, MAX_SPEED))
+        return request, path
+
+
+    def _run_client(self, client_index, start, end):
+        rng = random.Random(RANDOM_SEED + client_index)
+        results = {}
+
+        while True:
+            n = next(self._counter)
+            if self.max_requests is not None and n >= self.max_requests:
+                break
+
+            due = start + n / self.rate if self.rate else time.perf_counter()
+            if due >= end:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            request, path = self._pick(n, rng)
+            latencies, statuses, failures = results.setdefault(route_name(request), ([], {}, [0]))
+
+            try:
+                status, _ = self.target.request(request["method"], path, request.get("body"))
+            except Exception as e:
+                print("%s %s failed: %s" % (request["method"], path, str(e)), file=sys.stderr)
+                failures[0] += 1
+                continue
+
+            latencies.append((time.perf_counter() - due) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+        with self._lock:
+            for route, (latencies, statuses, failures) in results.items():
+                all_latencies, all_statuses, all_failures = self._results.setdefault(route, ([], {}, [0]))
+                all_latencies.extend(latencies)
+                for status, number in statuses.items():
+                    all_statuses[status] = all_statuses.get(status, 0) + number
+                all_failures[0] += failures[0]
+
+
+    def run(self):
+        '''
+        Returns the report, overall and per route
+        '''
+        start = time.perf_counter()
+        end = start + self.duration
+        threads = [threading.Thread(target=self._run_client, args=(i, start, end), daemon=True) for i in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        all_latencies = []
+        all_statuses = {}
+        all_failures = 0
+        routes = {}
+        for route, (latencies, statuses, failures) in sorted(self._results.items()):
+            routes[route] = summarize(latencies, statuses, failures[0], seconds)
+            all_latencies.extend(latencies)
+            for status, number in statuses.items():
+                all_statuses[status] = all_statuses.get(status, 0) + number
+            all_failures += failures[0]
+
+        return {
+            "seconds": seconds,
+            "overall": summarize(all_latencies, all_statuses, all_failures, seconds),
+            "routes": routes
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent request mix load generator")
+    parser.add_argument("--mix", help="JSON lines request mix, defaults to /program/now polls with some overrides and updates")
+    parser.add_argument("--replay", action="store_true", help="Send the mix in file order instead of drawing by weight")
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent clients")
+    parser.add_argument("--rate", type=float, default=0, help="Target requests per second over all clients, 0 sends as fast as they can")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests")
+    parser.add_argument("--pool", type=int, default=consts.DEFAULT_POOL_ID)
+    parser.add_argument("--url", help="Server to load, e.g. http://127.0.0.1:5000, instead of the Flask test client")
+    parser.add_argument("--database", default=os.path.join("database", "test_database.db"), help="Database the test client runs on a copy of")
+    parser.add_argument("--firmware-delay", type=float, default=0, help="Seconds each simulated firmware call takes with the test client")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    mix = load_mix(args.mix) if args.mix else DEFAULT_MIX
+
+    real_stdout = sys.stdout
+    with tempfile.TemporaryDirectory() as load_dir, open(os.devnull, "w") as devnull:
+        database = None
+
+        # The database, scheduler and firmware log every event, keep that out of the report
+        with contextlib.redirect_stdout(devnull):
+            if args.url:
+                target = HttpTarget(args.url)
+            else:
+                db_path = os.path.join(load_dir, "load.db")
+                copy_database(args.database, db_path)
+                database = Database("test", db_path)
+                app_module.database = database
+                app_module.scheduler = Scheduler(database, Actuator(firmware.SimulatedFirmware(args.firmware_delay)))
+                app_module.telemetry = Telemetry(database)
+                target = TestClientTarget(app_module.app)
+
+            status, programs = target.request("GET", "/program/all?pool=%d" % (args.pool, ))
+            program_ids = [program[consts.ID] for program in json.loads(programs)] if status == 200 else []
+            if not program_ids and any("{program_id}" in request["path"] for request in mix):
+                print("Pool %d has no programs, requests naming {program_id} will fail" % (args.pool, ), file=sys.stderr)
+
+            before = read_lock_metrics(target)
+            load_run = LoadRun(target, mix, args.replay, args.clients, args.rate, args.duration, args.requests, args.pool, program_ids)
+            report = load_run.run()
+            report["scheduler_lock"] = lock_contention(before, read_lock_metrics(target))
+
+        if database is not None:
+            database.close()
+
+    report["meta"] = {
+        "target": args.url or "test client",
+        "clients": args.clients,
+        "rate": args.rate,
+        "duration": args.duration,
+        "mix": args.mix or "default",
+        "replay": args.replay,
+        "timestamp": datetime.now().isoformat()
+    }
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        real_stdout.write(output + "\n")
+
+    overall = report["overall"]
+    print("%d requests in %.2f s, %.1f req/s, p50 %.2f ms, p99 %.2f ms, %.2f%% errors" % (
+        overall["requests"], report["seconds"], overall["throughput_rps"], overall.get("p50_ms", 0), overall.get("p99_ms", 0),
+        overall["error_rate"] * 100), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
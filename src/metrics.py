@@ -0,0 +1,96 @@
+import bisect
+import threading
+
+# Upper bounds in seconds, from a cached SQLite read up to a firmware call that times out
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram():
+    '''
+    Prometheus style histogram, one set of bucket counts per combination of label values
+    observe is a bisect and a few increments under a lock, cheap enough for every query and request
+    '''
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [per bucket counts (last one is +Inf), sum]
+        self._series = {}
+
+
+    def observe(self, value, *label_values):
+        position = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+
+    def render(self):
+        with self._lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self._series.items()]
+
+        lines = ["# HELP %s %s" % (self.name, self.help_text), "# TYPE %s histogram" % (self.name, )]
+
+        for label_values, counts, total in sorted(series):
+            labels = [(name, str(value)) for name, value in zip(self.label_names, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"), ), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(labels + [("le", le)]), cumulative))
+            lines.append("%s_sum%s %r" % (self.name, format_labels(labels), total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(labels), cumulative))
+
+        return "\n".join(lines)
+
+
+class Registry():
+    '''
+    Every histogram the /metrics endpoint exposes
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        '''
+        Returns the histogram called name, creating it on first use
+        '''
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(name, help_text, label_names, buckets)
+            return histogram
+
+
+    def render(self):
+        '''
+        Returns every histogram in the Prometheus text exposition format
+        '''
+        with self._lock:
+            histograms = sorted(self._histograms.values(), key=lambda histogram: histogram.name)
+        return "\n".join(histogram.render() for histogram in histograms) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, escape_label_value(value)) for name, value in labels) + "}"
+
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+REGISTRY = Registry()
@@ -0,0 +1,216 @@
+'''
+Schema migrations, applied in order inside one transaction
+The schema version is kept in PRAGMA user_version so a current database skips every migration
+'''
+import uuid
+import consts
+from program_index import get_seconds
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def is_current(conn):
+    return get_version(conn) >= LATEST_VERSION
+
+
+def migrate(conn, insert_default_seasons):
+    '''
+    [REQUIRES TRANSACTION]
+    Applies every migration newer than the database, returns the version it started at
+    insert_default_seasons - callable(conn, pool_id) seeding a pool's seasons from the defaults file
+    '''
+    version = get_version(conn)
+
+    for migration_version, migration in MIGRATIONS:
+        if migration_version > version:
+            print("Migrating database to version %d: %s" % (migration_version, migration.__doc__.strip().splitlines()[0]))
+            migration(conn, insert_default_seasons)
+            # PRAGMA does not take parameters, the version is always one of the ints above
+            conn.execute("PRAGMA user_version = %d" % (migration_version, ))
+
+    return version
+
+
+def migrate_pools(conn, insert_default_seasons):
+    '''
+    Pools, seasons and programs keyed by pool, with the default pool and its seasons
+    Idempotent, so it also adopts databases made before user_version was kept, including the single pool tables
+    '''
+    conn.execute("CREATE TABLE IF NOT EXISTS pools ("
+                        + consts.ID + " INTEGER PRIMARY KEY AUTOINCREMENT,"
+                        + consts.CONTROLLER_ID + " int NOT NULL)")
+
+    # Tables from before multiple pools have no pool_id, they are rebuilt and their rows moved to the default pool
+    if has_table(conn, "programs") and not has_column(conn, "programs", consts.POOL_ID):
+        rebuild_for_pools(conn)
+    else:
+        create_seasons_table(conn, "seasons")
+        create_programs_table(conn, "programs", "time")
+
+    conn.execute('''INSERT OR IGNORE INTO pools VALUES (?, ?)''', (consts.DEFAULT_POOL_ID, consts.DEFAULT_CONTROLLER_ID))
+    insert_default_seasons(conn, consts.DEFAULT_POOL_ID)
+
+
+def migrate_integer_times(conn, insert_default_seasons):
+    '''
+    Program start and durations as integer seconds instead of H:M:S text
+    Starts that only differed in formatting (8:00:00 and 08:00:00) collide, the older program is kept
+    '''
+    conn.execute('''ALTER TABLE programs RENAME TO programs_text_times''')
+    create_programs_table(conn, "programs", "int")
+
+    rows = conn.execute('''SELECT id, pool_id, speed, start, summer_duration, winter_duration FROM programs_text_times ORDER BY id''').fetchall()
+    converted = [(program_id, pool_id, speed, get_seconds(start), get_seconds(summer_duration), get_seconds(winter_duration))
+                 for program_id, pool_id, speed, start, summer_duration, winter_duration in rows]
+
+    inserted = conn.executemany('''INSERT OR IGNORE INTO programs VALUES (?, ?, ?, ?, ?, ?)''', converted).rowcount
+
+    if inserted != len(converted):
+        print("Dropped %d program(s) whose start time duplicated an older program" % (len(converted) - inserted, ))
+
+    copy_sequence(conn, "programs_text_times", "programs")
+    conn.execute('''DROP TABLE programs_text_times''')
+
+
+def migrate_run_history(conn, insert_default_seasons):
+    '''
+    Append-only log of every speed change with daily and monthly runtime rollups
+    The rollups are keyed by pool and period so a history query never reads the log
+    '''
+    conn.execute("CREATE TABLE runs ("
+                        + consts.ID + " INTEGER PRIMARY KEY AUTOINCREMENT,"
+                        + consts.POOL_ID + " int NOT NULL,"
+                        + consts.TIME + " real NOT NULL,"
+                        + consts.SPEED + " int NOT NULL,"
+                        + consts.SOURCE + " text NOT NULL)")
+    # Also ordered by id, finds each pool's latest run without a scan
+    conn.execute("CREATE INDEX runs_by_pool ON runs (" + consts.POOL_ID + ")")
+
+    for table_name, period in (("daily_runtime", consts.DAY), ("monthly_runtime", consts.MONTH)):
+        conn.execute("CREATE TABLE " + table_name + " ("
+                            + consts.POOL_ID + " int NOT NULL,"
+                            + period + " text NOT NULL,"
+                            + consts.SOURCE + " text NOT NULL,"
+                            + consts.RUNTIME_SECONDS + " real NOT NULL,"
+                            + consts.SPEED_HOURS + " real NOT NULL,"
+                            + "PRIMARY KEY (" + consts.POOL_ID + ", " + period + ", " + consts.SOURCE + ")) WITHOUT ROWID")
+
+
+def migrate_scheduler_state(conn, insert_default_seasons):
+    '''
+    Last checkpointed current and next event of each pool, as JSON
+    '''
+    conn.execute("CREATE TABLE scheduler_state ("
+                        + consts.POOL_ID + " INTEGER PRIMARY KEY,"
+                        + consts.CURRENT_EVENT + " text,"
+                        + consts.NEXT_EVENT + " text)")
+
+
+def migrate_data_version(conn, insert_default_seasons):
+    '''
+    Write counter shared by every process using the database, so each can tell when another changed it
+    The token names this database file, versions of a recreated one never compare equal to the old ones
+    '''
+    conn.execute("CREATE TABLE data_version ("
+                        + consts.ID + " INTEGER PRIMARY KEY CHECK (" + consts.ID + " = 1),"
+                        + consts.VERSION + " int NOT NULL,"
+                        + consts.TOKEN + " text NOT NULL)")
+    conn.execute('''INSERT INTO data_version VALUES (1, 0, ?)''', (uuid.uuid4().hex[:16], ))
+
+
+def migrate_telemetry(conn, insert_default_seasons):
+    '''
+    Pump telemetry samples, one row per sample with a column per metric, and their per minute and per hour rollups
+    '''
+    conn.execute("CREATE TABLE telemetry ("
+                        + consts.POOL_ID + " int NOT NULL,"
+                        + consts.TIME + " real NOT NULL,"
+                        + ",".join(metric + " real" for metric in consts.TELEMETRY_METRICS) + ")")
+    # Serves range queries and the retention prune, there are only a few pools to filter
+    conn.execute("CREATE INDEX telemetry_by_time ON telemetry (" + consts.TIME + ")")
+
+    conn.execute("CREATE TABLE telemetry_rollups ("
+                        + consts.POOL_ID + " int NOT NULL,"
+                        + consts.RESOLUTION + " int NOT NULL,"
+                        + consts.METRIC + " text NOT NULL,"
+                        + consts.BUCKET + " int NOT NULL,"
+                        + consts.COUNT + " int NOT NULL,"
+                        + consts.TOTAL + " real NOT NULL,"
+                        + consts.MINIMUM + " real NOT NULL,"
+                        + consts.MAXIMUM + " real NOT NULL,"
+                        + "PRIMARY KEY (" + consts.POOL_ID + ", " + consts.RESOLUTION + ", " + consts.METRIC + ", " + consts.BUCKET + ")) WITHOUT ROWID")
+
+
+# (version, migration) in the order they are applied, never renumber or remove one that has shipped
+MIGRATIONS = [
+    (1, migrate_pools),
+    (2, migrate_integer_times),
+    (3, migrate_run_history),
+    (4, migrate_scheduler_state),
+    (5, migrate_data_version),
+    (6, migrate_telemetry),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def create_seasons_table(conn, table_name):
+    conn.execute("CREATE TABLE IF NOT EXISTS " + table_name + " ("
+                        + consts.POOL_ID + " int NOT NULL,"
+                        + consts.SEASON + " text NOT NULL,"
+                        + consts.START_MONTH + " int NOT NULL,"
+                        + consts.START_DAY + " int NOT NULL,"
+                        + consts.PEAK_MONTH + " int NOT NULL,"
+                        + consts.PEAK_DAY + " int NOT NULL,"
+                        + "PRIMARY KEY (" + consts.POOL_ID + ", " + consts.SEASON + "))")
+
+
+def create_programs_table(conn, table_name, time_type):
+    conn.execute("CREATE TABLE IF NOT EXISTS " + table_name + " ("
+                        + consts.ID + " INTEGER PRIMARY KEY AUTOINCREMENT,"
+                        + consts.POOL_ID + " int NOT NULL,"
+                        + consts.SPEED + " int NOT NULL,"
+                        + consts.START + " " + time_type + " NOT NULL,"
+                        + consts.SUMMER_DURATION + " " + time_type + " NOT NULL,"
+                        + consts.WINTER_DURATION + " " + time_type + " NOT NULL,"
+                        + "UNIQUE (" + consts.POOL_ID + ", " + consts.START + "))")
+
+
+def rebuild_for_pools(conn):
+    conn.execute('''ALTER TABLE seasons RENAME TO seasons_single_pool''')
+    conn.execute('''ALTER TABLE programs RENAME TO programs_single_pool''')
+
+    create_seasons_table(conn, "seasons")
+    create_programs_table(conn, "programs", "time")
+
+    conn.execute('''INSERT INTO seasons SELECT ?, * FROM seasons_single_pool''', (consts.DEFAULT_POOL_ID, ))
+    conn.execute('''INSERT INTO programs SELECT id, ?, speed, start, summer_duration, winter_duration FROM programs_single_pool''',
+                 (consts.DEFAULT_POOL_ID, ))
+
+    copy_sequence(conn, "programs_single_pool", "programs")
+
+    conn.execute('''DROP TABLE seasons_single_pool''')
+    conn.execute('''DROP TABLE programs_single_pool''')
+
+
+def copy_sequence(conn, old_table, new_table):
+    '''
+    Keeps handing out ids after the highest ever used in old_table, not just the highest remaining
+    '''
+    # new_table only gets a row on its first insert, which an empty copy never does
+    conn.execute('''INSERT INTO sqlite_sequence (name, seq) SELECT ?, 0
+                    WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?) AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)''',
+                 (new_table, new_table, old_table))
+    conn.execute('''UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = ?)
+                    WHERE name = ? AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)''',
+                 (old_table, new_table, old_table))
+
+
+def has_table(conn, table_name):
+    return conn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?''', (table_name, )).fetchone() is not None
+
+
+def has_column(conn, table_name, column_name):
+    return any(column[1] == column_name for column in conn.execute("PRAGMA table_info(" + table_name + ")"))
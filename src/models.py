@@ -0,0 +1,198 @@
+'''
+Program and season value objects, parsed and validated once where they enter: an API request or a SQLite row
+Everything past that point works on integer seconds and month/day numbers, never on the strings
+'''
+from datetime import date
+import consts
+from program_index import format_seconds, get_seconds
+
+# Season dates are placed in every year, including ones without 2-29, so they are checked against a common year
+COMMON_YEAR = 2001
+
+
+def parse_speed(speed):
+    '''
+    Raises ValueError unless speed is a whole number of at least 0, as an int or its string
+    '''
+    if isinstance(speed, bool) or not isinstance(speed, (int, str)):
+        raise ValueError("Speed must be a whole number")
+
+    try:
+        speed = int(speed)
+    except ValueError:
+        raise ValueError("Speed must be a whole number")
+
+    if speed < 0:
+        raise ValueError("Speed must be a whole number")
+
+    return speed
+
+
+def parse_id(value, name):
+    '''
+    Raises ValueError unless value is a whole number, as an int or its string
+    name - what the id is of, for the message
+    '''
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError("%s id must be a whole number" % (name, ))
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("%s id must be a whole number" % (name, ))
+
+
+def parse_time(time_string):
+    '''
+    Returns seconds since midnight, raises ValueError unless time_string is H:M:S
+    '''
+    if not isinstance(time_string, str):
+        raise ValueError("Times must be formatted as H:M:S")
+
+    try:
+        return get_seconds(time_string)
+    except ValueError:
+        raise ValueError("Times must be formatted as H:M:S")
+
+
+def parse_month_day(date_string):
+    '''
+    Returns (month, day), raises ValueError unless date_string is M-D and a day every year has
+    '''
+    try:
+        month, day = (int(part) for part in date_string.split("-"))
+        date(COMMON_YEAR, month, day)
+    except (AttributeError, ValueError):
+        raise ValueError("Season dates must be formatted as M-D")
+
+    return month, day
+
+
+class Program():
+    '''
+    A program as stored, start and durations in seconds, never modified once made
+    id - None until it is inserted
+    '''
+    __slots__ = ("id", "pool_id", "speed", "start", "summer_duration", "winter_duration", "max_duration")
+
+    def __init__(self, program_id, pool_id, speed, start, summer_duration, winter_duration):
+        self.id = program_id
+        self.pool_id = pool_id
+        self.speed = speed
+        self.start = start
+        self.summer_duration = summer_duration
+        self.winter_duration = winter_duration
+        # Durations interpolate between the summer and winter ones, so this is the longest it runs on any day
+        self.max_duration = max(summer_duration, winter_duration)
+
+
+    @classmethod
+    def parse(cls, program_id, pool_id, speed, start, summer_duration, winter_duration):
+        '''
+        Raises ValueError if the speed is not a whole number or a time is not H:M:S
+        '''
+        return cls(program_id, pool_id, parse_speed(speed), parse_time(start), parse_time(summer_duration), parse_time(winter_duration))
+
+
+    @classmethod
+    def from_row(cls, row):
+        '''
+        row - id, speed, start, summer_duration, winter_duration, pool_id as selected by Database
+        '''
+        return cls(row[0], row[5], row[1], row[2], row[3], row[4])
+
+
+    def replace(self, speed=None, start=None, summer_duration=None, winter_duration=None):
+        '''
+        Returns a copy with the passed fields changed
+        '''
+        return Program(self.id,
+                       self.pool_id,
+                       self.speed if speed is None else speed,
+                       self.start if start is None else start,
+                       self.summer_duration if summer_duration is None else summer_duration,
+                       self.winter_duration if winter_duration is None else winter_duration)
+
+
+    def to_dict(self, fields=None):
+        '''
+        The API form, times as HH:MM:SS strings
+        fields - only these keys of it, in this order, all of them by default
+        '''
+        if fields is not None:
+            return {field: API_FIELDS[field](self) for field in fields}
+
+        return {
+            consts.ID: self.id,
+            consts.SPEED: self.speed,
+            consts.START: format_seconds(self.start),
+            consts.SUMMER_DURATION: format_seconds(self.summer_duration),
+            consts.WINTER_DURATION: format_seconds(self.winter_duration),
+            consts.POOL_ID: self.pool_id
+        }
+
+
+    def __repr__(self):
+        return "Program(%r)" % (self.to_dict(), )
+
+
+# Program.to_dict key -> its value of a program
+API_FIELDS = {
+    consts.ID: lambda program: program.id,
+    consts.SPEED: lambda program: program.speed,
+    consts.START: lambda program: format_seconds(program.start),
+    consts.SUMMER_DURATION: lambda program: format_seconds(program.summer_duration),
+    consts.WINTER_DURATION: lambda program: format_seconds(program.winter_duration),
+    consts.POOL_ID: lambda program: program.pool_id
+}
+
+
+class Season():
+    '''
+    A pool's summer or winter, start and peak as month and day numbers, never modified once made
+    '''
+    __slots__ = ("name", "start_month", "start_day", "peak_month", "peak_day")
+
+    def __init__(self, name, start_month, start_day, peak_month, peak_day):
+        self.name = name
+        self.start_month = start_month
+        self.start_day = start_day
+        self.peak_month = peak_month
+        self.peak_day = peak_day
+
+
+    @classmethod
+    def from_row(cls, row):
+        '''
+        row - season, start_month, start_day, peak_month, peak_day as selected by Database
+        '''
+        return cls(*row)
+
+
+    def start_date(self, year):
+        return date(year, self.start_month, self.start_day)
+
+
+    def peak_date(self, year):
+        return date(year, self.peak_month, self.peak_day)
+
+
+    def key(self):
+        '''
+        Equal for seasons that give the same duration curves
+        '''
+        return (self.start_month, self.start_day, self.peak_month, self.peak_day)
+
+
+    def to_dict(self):
+        '''
+        The API form, dates as M-D strings
+        '''
+        return {
+            consts.START: "%d-%d" % (self.start_month, self.start_day),
+            consts.PEAK: "%d-%d" % (self.peak_month, self.peak_day)
+        }
+
+
+    def __repr__(self):
+        return "Season(%r, %r)" % (self.name, self.to_dict())
@@ -0,0 +1,198 @@
+import bisect
+import collections
+import functools
+
+SECONDS_PER_DAY = 86400
+
+
+# Every time of day in HH:MM:SS form fits, so writes and index updates rarely parse the same string twice
+@functools.lru_cache(maxsize=1 << 17)
+def get_seconds(time_string):
+    '''
+    Converts an H:M:S string to seconds since midnight
+    Accepts what strptime("%H:%M:%S") does, one or two digits per field, without its cost on every program load
+    '''
+    parts = time_string.split(":")
+
+    if len(parts) != 3:
+        raise ValueError("time data %r does not match format H:M:S" % (time_string, ))
+
+    hours, minutes, seconds = parts
+    if not (hours.isdigit() and minutes.isdigit() and seconds.isdigit()) or len(hours) > 2 or len(minutes) > 2 or len(seconds) > 2:
+        raise ValueError("time data %r does not match format H:M:S" % (time_string, ))
+
+    hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError("time data %r is out of range" % (time_string, ))
+
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def format_seconds(seconds):
+    '''
+    Converts seconds since midnight to an HH:MM:SS string
+    '''
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class ProgramIndex():
+    '''
+    models.Program objects sorted by start time, keyed by integer seconds since midnight
+    Start times are unique so every key holds exactly one program
+    Doubles as an interval index: a program's run starts within the longest duration before any time it covers
+    Not thread safe, Database guards it with its cache lock
+    '''
+
+    def __init__(self, programs=()):
+        programs = sorted(programs, key=lambda program: program.start)
+
+        self._starts = [program.start for program in programs]
+        self._programs = programs
+        self._start_by_id = {program.id: program.start for program in programs}
+        self._snapshot = None
+        # Programs per max duration and the longest of them, None until max_duration() first needs them
+        self._duration_counts = None
+        self._max_duration = None
+
+
+    @classmethod
+    def from_sorted(cls, programs):
+        '''
+        Builds the index from programs already ordered by start, skips sorting
+        '''
+        program_index = cls()
+        for program in programs:
+            program_index._starts.append(program.start)
+            program_index._programs.append(program)
+            program_index._start_by_id[program.id] = program.start
+        return program_index
+
+
+    def __len__(self):
+        return len(self._starts)
+
+
+    def add(self, program):
+        position = bisect.bisect_left(self._starts, program.start)
+
+        self._starts.insert(position, program.start)
+        self._programs.insert(position, program)
+        self._start_by_id[program.id] = program.start
+        self._snapshot = None
+
+        if self._duration_counts is not None:
+            duration = program.max_duration
+            self._duration_counts[duration] += 1
+            self._max_duration = max(self._max_duration, duration)
+
+
+    def remove(self, program_id):
+        '''
+        Returns the removed program, or None if program_id is not indexed
+        '''
+        start = self._start_by_id.pop(program_id, None)
+        if start is None:
+            return None
+
+        position = bisect.bisect_left(self._starts, start)
+        del self._starts[position]
+        program = self._programs.pop(position)
+        self._snapshot = None
+
+        if self._duration_counts is not None:
+            duration = program.max_duration
+            self._duration_counts[duration] -= 1
+            if self._duration_counts[duration] == 0:
+                del self._duration_counts[duration]
+                if duration == self._max_duration:
+                    self._max_duration = max(self._duration_counts, default=0)
+
+        return program
+
+
+    def get(self, program_id):
+        '''
+        Returns the indexed program with program_id, or None
+        '''
+        start = self._start_by_id.get(program_id)
+        if start is None:
+            return None
+        return self._programs[bisect.bisect_left(self._starts, start)]
+
+
+    def max_duration(self):
+        '''
+        Returns the longest any indexed program runs on any day, in seconds
+        Counted once on first use, then kept up to date by add and remove
+        '''
+        if self._duration_counts is None:
+            self._duration_counts = collections.Counter(program.max_duration for program in self._programs)
+            self._max_duration = max(self._duration_counts, default=0)
+        return self._max_duration
+
+
+    def starting_within(self, low, high):
+        '''
+        Returns (start seconds, program) for every program starting from low through high, wrapping around midnight
+        low may be negative and high past the end of the day, the range must be less than a day long
+        '''
+        if high - low >= SECONDS_PER_DAY:
+            return list(zip(self._starts, self._programs))
+
+        low %= SECONDS_PER_DAY
+        high %= SECONDS_PER_DAY
+
+        if low <= high:
+            ranges = [(low, high)]
+        else:
+            ranges = [(low, SECONDS_PER_DAY - 1), (0, high)]
+
+        found = []
+        for range_low, range_high in ranges:
+            first = bisect.bisect_left(self._starts, range_low)
+            last = bisect.bisect_right(self._starts, range_high)
+            found.extend(zip(self._starts[first:last], self._programs[first:last]))
+
+        return found
+
+
+    def next_program(self, seconds):
+        '''
+        Returns (program, start seconds, starts tomorrow) for the first program starting at or after seconds
+        Wraps around to the first program of the next day, returns (None, None, False) when empty
+        '''
+        if not self._starts:
+            return None, None, False
+
+        position = bisect.bisect_left(self._starts, seconds)
+        if position == len(self._starts):
+            return self._programs[0], self._starts[0], True
+
+        return self._programs[position], self._starts[position], False
+
+
+    def page(self, after=None, limit=None):
+        '''
+        Returns up to limit programs in (start, id) order that come after the (start, id) key after, all of them by default
+        A key whose program was since removed still finds its place, so pages neither repeat nor skip the programs left
+        '''
+        if after is None and limit is None:
+            return self.programs()
+
+        position = 0
+        if after is not None:
+            start, program_id = after
+            position = bisect.bisect_left(self._starts, start)
+            if position < len(self._starts) and self._starts[position] == start and self._programs[position].id <= program_id:
+                position += 1
+
+        return self._programs[position:] if limit is None else self._programs[position:position + limit]
+
+
+    def programs(self):
+        '''
+        Returns every program ordered by start time as a tuple, rebuilt only after a change
+        '''
+        if self._snapshot is None:
+            self._snapshot = tuple(self._programs)
+        return self._snapshot
@@ -1,42 +1,191 @@
 import abc
+import collections
+import heapq
+import itertools
 import threading
 import sched
-import firmware
-from datetime import datetime
+from actuator import Actuator
+from broadcast import Broadcaster
+from checkpoint import StateCheckpoint
+from clock import Clock
+from history import RunHistory
+from datetime import datetime, timedelta
 import time
 import consts
+import metrics
+
+LOCK_WAIT_SECONDS = metrics.REGISTRY.histogram("poolfilter_scheduler_lock_wait_seconds",
+                                               "Time API requests waited to acquire the scheduler lock")
+LOCK_HOLD_SECONDS = metrics.REGISTRY.histogram("poolfilter_scheduler_lock_hold_seconds",
+                                               "Time the scheduler lock was held, by the API or by the event thread between sleeps",
+                                               ("holder", ))
+EVENT_LAG_SECONDS = metrics.REGISTRY.histogram("poolfilter_scheduler_event_lag_seconds",
+                                               "How late events fired relative to their event time")
 
 
 class Scheduler():
+    '''
+    Runs the programs of every pool from a single event thread
+    Pending events of all pools sit in one deadline heap, the thread sleeps until the earliest one
+    '''
 
-    def __init__(self, database):
+    def __init__(self, database, actuator=None, history=None, checkpoint=None, clock=None, broadcaster=None):
         self.database = database
+        # Every reading of the time goes through the clock, a VirtualClock runs the schedule as fast as it can
+        self.clock = clock if clock is not None else Clock()
+        # Speed changes are queued to the actuator so firmware I/O never runs under the lock
+        self.actuator = actuator if actuator is not None else Actuator()
+        # Likewise buffered to the run log, written by its own thread
+        self.history = history if history is not None else RunHistory(database, self.clock)
+        # And every transition to the checkpoint a restart resumes from
+        self.checkpoint = checkpoint if checkpoint is not None else StateCheckpoint(database)
+        # And to the clients streaming the pool's state
+        self.broadcaster = broadcaster if broadcaster is not None else Broadcaster()
         self._lock = threading.Lock()
-        self._current_event = None
-        self._next_event = None
+        # Wakes the event thread when an earlier deadline is scheduled, it otherwise sleeps until the next one
+        self._next_event_changed = threading.Condition(self._lock)
+        self._pools = {}
+
+        # Published Scheduler.Snapshot per pool, replaced whole after every transition so readers never need the lock
+        self._snapshots = {}
+
+        # Heap of (event timestamp, tie breaker, event), entries whose event is no longer its pool's next event are skipped
+        self._deadlines = []
+        self._deadline_sequence = itertools.count()
+
+        # How late events fire relative to their event_time, in milliseconds
+        self._jitter_count = 0
+        self._jitter_total_ms = 0.0
+        self._jitter_max_ms = 0.0
+        self._jitter_last_ms = 0.0
+
+        # Program and season writes that recomputed a pool's next event, and those shown unable to change it
+        self._reschedule_count = 0
+        self._reschedule_avoided_count = 0
+
+        # perf_counter() when acquire() last got the lock
+        self._acquired_at = None
+
+        # Called with each event after it is invoked, see add_listener
+        self._listeners = []
 
         self._run_event_thread = threading.Thread(target=self._run_event, daemon=True)
         self._run_event_thread.start()
 
+        states = self.checkpoint.load()
+
         with self._lock:
-            self.update_next_event()
+            for pool in self.database.get_all_pools():
+                self.add_pool(pool[consts.ID], pool[consts.CONTROLLER_ID], states.get(pool[consts.ID]))
 
 
     def _run_event(self):
-        while True:
-            with self._lock:
-                if self._next_event is not None and self._next_event.event_time.timestamp() <= time.time():
-                    event = self._next_event
-                    self._next_event = None
-                    event.invoke(self)
-            time.sleep(1)
+        with self._lock:
+            awake_since = time.perf_counter()
+            while True:
+                self._discard_cancelled_deadlines()
+
+                if not self._deadlines:
+                    LOCK_HOLD_SECONDS.observe(time.perf_counter() - awake_since, "event")
+                    self.clock.wait(self._next_event_changed)
+                    awake_since = time.perf_counter()
+                    continue
+
+                event_timestamp, _, event = self._deadlines[0]
+                delay = event_timestamp - self.clock.time()
+                if delay > 0:
+                    LOCK_HOLD_SECONDS.observe(time.perf_counter() - awake_since, "event")
+                    self.clock.wait(self._next_event_changed, delay)
+                    awake_since = time.perf_counter()
+                    continue
+
+                heapq.heappop(self._deadlines)
+                self._pools[event.pool_id].next_event = None
+                self._record_jitter(-delay * 1000)
+                event.invoke(self)
+                self._publish(event.pool_id)
+                for listener in self._listeners:
+                    listener(event)
+
+
+    def add_listener(self, listener):
+        '''
+        listener - callable(event) run by the event thread under the lock after each event is invoked, must not block
+        '''
+        with self._lock:
+            self._listeners.append(listener)
+
+
+    def _publish(self, pool_id):
+        '''
+        [REQUIRES LOCK]
+        Swaps in a new snapshot of the pool's current and next event
+        '''
+        pool = self._pools[pool_id]
+        snapshot = self._snapshots[pool_id] = Scheduler.Snapshot(pool.current_event, pool.next_event)
+        self.checkpoint.save(pool_id, snapshot)
+        if self.broadcaster.has_subscribers(pool_id):
+            self.broadcaster.publish(pool_id, self.get_current_event(pool_id))
+
+
+    def _discard_cancelled_deadlines(self):
+        '''
+        [REQUIRES LOCK]
+        Pops heap entries for events that were replaced or whose pool was removed
+        '''
+        while self._deadlines:
+            event = self._deadlines[0][2]
+            pool = self._pools.get(event.pool_id)
+            if pool is not None and pool.next_event is event:
+                return
+            heapq.heappop(self._deadlines)
+
+
+    def _record_jitter(self, jitter_ms):
+        '''
+        [REQUIRES LOCK]
+        '''
+        self._jitter_count += 1
+        self._jitter_total_ms += jitter_ms
+        self._jitter_max_ms = max(self._jitter_max_ms, jitter_ms)
+        self._jitter_last_ms = jitter_ms
+        EVENT_LAG_SECONDS.observe(jitter_ms / 1000)
+        print("Firing event %.3f ms after its event time" % (jitter_ms, ))
+
+
+    def get_jitter(self):
+        '''
+        Returns how late events have fired relative to their event time, in milliseconds
+        Read without the lock, the mean may be off by the sample being recorded
+        '''
+        mean = self._jitter_total_ms / self._jitter_count if self._jitter_count else 0.0
+        return {
+            "count": self._jitter_count,
+            "last_ms": self._jitter_last_ms,
+            "mean_ms": mean,
+            "max_ms": self._jitter_max_ms
+        }
+
+
+    def get_reschedule_stats(self):
+        '''
+        Returns how many program and season writes recomputed the next event and how many were skipped
+        '''
+        return {
+            "recomputed": self._reschedule_count,
+            "avoided": self._reschedule_avoided_count
+        }
 
 
     def acquire(self):
+        start = time.perf_counter()
         self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        LOCK_WAIT_SECONDS.observe(self._acquired_at - start)
 
 
     def release(self):
+        LOCK_HOLD_SECONDS.observe(time.perf_counter() - self._acquired_at, "api")
         self._lock.release()
 
 
@@ -48,48 +197,198 @@ class Scheduler():
         self.release()
 
 
+    def add_pool(self, pool_id, controller_id, state=None):
+        '''
+        [REQUIRES LOCK]
+        Starts scheduling the pool's programs
+        state - (current event dict, next event dict) checkpointed before a restart, resumed where it left off
+        '''
+        self._pools[pool_id] = Scheduler.Pool(pool_id, controller_id)
+        if state is None or not self._resume(pool_id, *[Scheduler.ProgramEvent.from_dict(event) for event in state]):
+            self.update_next_event(pool_id)
+        self._publish(pool_id)
+
+
+    def _resume(self, pool_id, current_event, next_event):
+        '''
+        [REQUIRES LOCK]
+        Picks up a run that was in progress, or should have started, when the service stopped
+        Returns False if there was none and the next event has to come from the programs
+        '''
+        pool = self._pools[pool_id]
+        now = self.clock.now()
+
+        if isinstance(current_event, Scheduler.StartEvent):
+            # The pump kept running through the restart, restating the same speed does not cycle it
+            # A run that ended while the service was down is only stopped, right away
+            pool.current_event = current_event
+            end = current_event.event_time + current_event.duration
+            if end > now:
+                self.actuator.set_speed(current_event.speed, pool.controller_id)
+
+            # Its start may still have been buffered when the service stopped, then the run is logged from its event time
+            last_run = self.history.get_last_run(pool_id)
+            if last_run is None or last_run[0] < current_event.event_time.timestamp():
+                self.history.record(pool_id, current_event.speed, current_event.source, current_event.event_time.timestamp())
+            self._schedule_event(Scheduler.StopEvent(end, pool_id, current_event.source))
+            print("Resumed - %s" % (str(current_event), ))
+            return True
+
+        if isinstance(next_event, Scheduler.StartEvent) and next_event.event_time <= now < next_event.event_time + next_event.duration:
+            # Fires right away and stops at its original end
+            pool.current_event = current_event
+            self._schedule_event(next_event)
+            return True
+
+        pool.current_event = current_event
+        return False
+
+
+    def remove_pool(self, pool_id):
+        '''
+        [REQUIRES LOCK]
+        Stops scheduling the pool, turning its filter off if it was running
+        '''
+        pool = self._pools.pop(pool_id, None)
+        self._snapshots.pop(pool_id, None)
+        self.checkpoint.remove(pool_id)
+        self.broadcaster.close_pool(pool_id)
+        if pool is not None and isinstance(pool.current_event, Scheduler.StartEvent):
+            # Deleting the pool is a user action like an override
+            self._set_speed(pool, 0, consts.OVERRIDE)
+
+
+    def _set_speed(self, pool, speed, source):
+        '''
+        [REQUIRES LOCK]
+        Queues the speed to the pool's controller and logs the change, neither waits on I/O
+        '''
+        self.actuator.set_speed(speed, pool.controller_id)
+        self.history.record(pool.pool_id, speed, source)
+
+
+    def has_pool(self, pool_id):
+        '''
+        [REQUIRES LOCK]
+        '''
+        return pool_id in self._pools
+
+
     def override_current_event(self, event):
         '''
         [REQUIRES LOCK]
-        Cancels the current next event
+        Cancels the current next event of the event's pool
         Invokes the passed event
         '''
+        pool = self._pools[event.pool_id]
 
-        if self._next_event is not None:
-            self._next_event = None
+        if pool.next_event is not None:
+            pool.next_event = None
 
         self._schedule_event(event)
+        self._publish(event.pool_id)
 
 
-    def update_next_event(self):
+    def update_next_event(self, pool_id):
         '''
         [REQUIRES LOCK]
+        Replaces the pool's pending event with its next program start, or cancels it when no program is left
         '''
-        next_event = self.database.get_next_event()
+        next_event = self.database.get_next_event(pool_id, self.clock.now())
+        # The replaced event's heap entry is skipped when it comes due
+        self._pools[pool_id].next_event = None
         if next_event is not None:
-            self._next_event = None
             self._schedule_event(next_event)
+        self._publish(pool_id)
 
-    def get_current_event(self):
+
+    def programs_changed(self, pool_id, programs=(), deleted_ids=()):
         '''
         [REQUIRES LOCK]
+        Recomputes the pool's next event only if the written programs can change it
+        programs - models.Program objects added or updated, as stored
+        deleted_ids - ids of deleted programs
+        '''
+        next_event = self._pools[pool_id].next_event
+
+        if next_event is None:
+            # Nothing pending, a new program may be the first
+            affected = bool(programs)
+        elif not self._is_program_start(next_event):
+            # A run in progress or an override ends as it was scheduled, the stop looks up the next program when it fires
+            affected = False
+        elif next_event.program_id in deleted_ids:
+            affected = True
+        else:
+            now = self.clock.now()
+            affected = any(program.id == next_event.program_id or self._next_start(program, now) < next_event.event_time
+                           for program in programs)
+
+        self._reschedule(pool_id, affected)
+
+
+    def seasons_changed(self, pool_id):
+        '''
+        [REQUIRES LOCK]
+        Recomputes the pool's next event only if it is a program start, whose duration the seasons interpolate
+        '''
+        self._reschedule(pool_id, self._is_program_start(self._pools[pool_id].next_event))
+
+
+    def _reschedule(self, pool_id, affected):
+        '''
+        [REQUIRES LOCK]
+        '''
+        if affected:
+            self._reschedule_count += 1
+            self.update_next_event(pool_id)
+        else:
+            self._reschedule_avoided_count += 1
+
+
+    @staticmethod
+    def _is_program_start(event):
+        return isinstance(event, Scheduler.StartEvent) and event.program_id is not None
+
+
+    @staticmethod
+    def _next_start(program, now):
+        '''
+        The first time program starts at or after now, as Database.get_next_program finds it
+        '''
+        start = datetime(now.year, now.month, now.day) + timedelta(seconds=program.start)
+        if start < now:
+            start += timedelta(days=1)
+        return start
+
+
+    def get_current_event(self, pool_id):
+        '''
+        Reads the pool's published snapshot, does not need the lock
+        '''
+        return Scheduler.describe(*self._snapshots[pool_id])
+
+
+    @staticmethod
+    def describe(current_event, next_event):
+        '''
+        The /program/now form of a pool's current and next event
         start - current event event_time
         Start Event end - start + duration
         Stop Event end - next event start
         '''
-
         speed = 0
         start = ""
         end = ""
 
-        if self._current_event is not None:
-            start = self._current_event.event_time.strftime("%H:%M:%S")
+        if current_event is not None:
+            start = current_event.event_time.strftime("%H:%M:%S")
 
-        if isinstance(self._current_event, Scheduler.StartEvent):
-            end = (self._current_event.event_time + self._current_event.duration).strftime("%H:%M:%S")
-            speed = self._current_event.speed
-        elif (isinstance(self._current_event, Scheduler.StopEvent) or self._current_event is None) and self._next_event is not None:
-            end = self._next_event.event_time.strftime("%H:%M:%S")
+        if isinstance(current_event, Scheduler.StartEvent):
+            end = (current_event.event_time + current_event.duration).strftime("%H:%M:%S")
+            speed = current_event.speed
+        elif (isinstance(current_event, Scheduler.StopEvent) or current_event is None) and next_event is not None:
+            end = next_event.event_time.strftime("%H:%M:%S")
 
         return {
             consts.SPEED: speed,
@@ -101,37 +400,99 @@ class Scheduler():
     def _schedule_event(self, event):
         '''
         [REQUIRES LOCK]
-        Schedules the passed event
+        Schedules the passed event for its pool
         '''
 
         if not isinstance(event, Scheduler.ProgramEvent):
             raise TypeError("Scheduler _schedule_event not passed an event, had type %s" % (type(event).__name__,))
 
-        if self._next_event is not None:
+        pool = self._pools[event.pool_id]
+
+        if pool.next_event is not None:
             raise ValueError("Cannot schedule event if the is already one scheduled. Please remove it first!")
 
         print("Scheduled event - %s" % (str(event),))
 
-        self._next_event = event
+        pool.next_event = event
+        deadline = (event.event_time.timestamp(), next(self._deadline_sequence), event)
+        heapq.heappush(self._deadlines, deadline)
+
+        # Cancelled entries are normally dropped as they reach the top, compact if rescheduling piles them up
+        if len(self._deadlines) > 2 * len(self._pools) + 64:
+            self._deadlines = [entry for entry in self._deadlines
+                               if entry[2].pool_id in self._pools and self._pools[entry[2].pool_id].next_event is entry[2]]
+            heapq.heapify(self._deadlines)
+
+        # Only an event that is now the earliest changes how long the event thread should sleep
+        if self._deadlines[0] is deadline:
+            self._next_event_changed.notify()
+
+
+    # Immutable view of a pool's state between transitions
+    Snapshot = collections.namedtuple("Snapshot", ["current_event", "next_event"])
+
+
+    class Pool():
+        '''
+        Scheduling state of one pool
+        '''
+        def __init__(self, pool_id, controller_id):
+            self.pool_id = pool_id
+            self.controller_id = controller_id
+            self.current_event = None
+            self.next_event = None
 
 
     class ProgramEvent():
-        def __init__(self, event_time):
+        '''
+        source - consts.PROGRAM for scheduled events, consts.OVERRIDE for ones from /override
+        '''
+        def __init__(self, event_time, pool_id, source=consts.PROGRAM):
             self.event_time = event_time
+            self.pool_id = pool_id
+            self.source = source
 
 
         def invoke(self, scheduler):
-            scheduler._current_event = self
+            scheduler._pools[self.pool_id].current_event = self
+
+        def to_dict(self):
+            return {
+                consts.EVENT: self.EVENT,
+                consts.TIME: self.event_time.isoformat(),
+                consts.POOL_ID: self.pool_id,
+                consts.SOURCE: self.source
+            }
+
+        @staticmethod
+        def from_dict(event):
+            '''
+            Rebuilds an event from to_dict, None stays None
+            '''
+            if event is None:
+                return None
+
+            event_time = datetime.fromisoformat(event[consts.TIME])
+            if event[consts.EVENT] == Scheduler.StartEvent.EVENT:
+                return Scheduler.StartEvent(event_time, timedelta(seconds=event[consts.DURATION]), event[consts.SPEED],
+                                            event[consts.POOL_ID], event[consts.SOURCE], event.get(consts.PROGRAM_ID))
+            return Scheduler.StopEvent(event_time, event[consts.POOL_ID], event[consts.SOURCE])
 
         def __str__(self):
-            return "Event Time: %s" % (self.event_time,)
+            return "Pool %s Event Time: %s, Source: %s" % (self.pool_id, self.event_time, self.source)
 
 
     class StartEvent(ProgramEvent):
-        def __init__(self, event_time, duration, speed):
-            super().__init__(event_time)
+        '''
+        program_id - the program it runs, None for an override
+        '''
+        EVENT = consts.START
+
+        def __init__(self, event_time, duration, speed, pool_id, source=consts.PROGRAM, program_id=None):
+            super().__init__(event_time, pool_id, source)
             self.duration = duration
             self.speed = speed
+            self.program_id = program_id
 
 
         def invoke(self, scheduler):
@@ -140,10 +501,18 @@ class Scheduler():
             Adds stop event
             '''
             super().invoke(scheduler)
-            firmware.set_speed(self.speed)
-            stop_event = Scheduler.StopEvent(datetime.now() + self.duration)
+            scheduler._set_speed(scheduler._pools[self.pool_id], self.speed, self.source)
+            # From the event time rather than now, so a run resumed late still stops when it was meant to
+            stop_event = Scheduler.StopEvent(self.event_time + self.duration, self.pool_id, self.source)
             scheduler._schedule_event(stop_event)
 
+        def to_dict(self):
+            event = super().to_dict()
+            event[consts.DURATION] = self.duration.total_seconds()
+            event[consts.SPEED] = self.speed
+            event[consts.PROGRAM_ID] = self.program_id
+            return event
+
         def __str__(self):
             return "Start " + super().__str__() +\
                    ", Duration: %s, "\
@@ -152,14 +521,23 @@ class Scheduler():
 
 
     class StopEvent(ProgramEvent):
+        EVENT = consts.STOP
+
         def invoke(self, scheduler):
             '''
             Turns off filter
             Adds start event for next program
             '''
+            started = scheduler._pools[self.pool_id].current_event
             super().invoke(scheduler)
-            firmware.set_speed(0)
-            next_event = scheduler.database.get_next_event()
+            scheduler._set_speed(scheduler._pools[self.pool_id], 0, self.source)
+
+            # As in Database.get_schedule, a zero length program must not be found again at its own start time
+            now = scheduler.clock.now()
+            if isinstance(started, Scheduler.StartEvent) and started.event_time >= now:
+                now = started.event_time + timedelta(microseconds=1)
+
+            next_event = scheduler.database.get_next_event(self.pool_id, now)
             if next_event is not None:
                 scheduler._schedule_event(next_event)
 
@@ -0,0 +1,190 @@
+'''
+Runs the real scheduler through a whole year on a VirtualClock, in seconds of wall time
+Works on a scratch copy of the database, writes every event the scheduler fired as one JSON line
+and checks them against Database.get_schedule, so season interpolation and the stop -> next start
+chaining of the event classes are exercised exactly as they run in production
+Durations on the season start and peak days are also checked against the programs directly
+
+Run from the repository root:
+    python src/simulate.py --year 2021 --output trace.jsonl    # exits 1 if the trace differs from the schedule
+'''
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# The app package reads its config from the environment, the simulation never builds the app
+os.environ["FLASK_ENV"] = "development"
+
+import consts
+from actuator import Actuator
+from clock import VirtualClock
+from database import Database
+from scheduler import Scheduler
+
+# Seconds two durations may differ by and still be equal, they are interpolated in floating point
+DURATION_TOLERANCE_SECONDS = 1e-6
+
+
+class NullFirmware():
+    '''
+    Acknowledges every speed at once, the trace is taken from the scheduler rather than the pump
+    '''
+
+    def set_speed(self, speed, controller_id, timeout=None):
+        return True
+
+
+def copy_database(source_path, target_path):
+    '''
+    Copies through the backup API so a database with an open WAL is copied consistently
+    '''
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def simulate(db_path, start, end, pool_ids=None):
+    '''
+    Returns (trace, expected, seasons) where trace is [(fired at, event)] in firing order, expected is pool id -> [event]
+    and seasons is pool id -> (models.Season by name, program start seconds -> models.Program)
+    '''
+    clock = VirtualClock(start, end)
+    database = Database("test", db_path, clock)
+
+    if pool_ids is None:
+        pool_ids = [pool[consts.ID] for pool in database.get_all_pools()]
+    pool_ids = set(pool_ids)
+
+    # Start every pool from its programs, not from whatever the copied database was running
+    database.save_scheduler_states({pool[consts.ID]: None for pool in database.get_all_pools()})
+
+    expected = {pool_id: [event for event in database.get_schedule(pool_id, start, end) if event.event_time < end]
+                for pool_id in pool_ids}
+    seasons = {pool_id: (database.get_seasons(pool_id), {program.start: program for program in database.get_all_programs(pool_id)})
+               for pool_id in pool_ids}
+
+    trace = []
+    if not any(expected.values()):
+        return trace, expected, seasons
+
+    scheduler = Scheduler(database, Actuator(NullFirmware()), clock=clock)
+    scheduler.add_listener(lambda event: trace.append((clock.now(), event)) if event.pool_id in pool_ids else None)
+    clock.finished.wait()
+
+    scheduler.history.flush()
+    return trace, expected, seasons
+
+
+def compare(trace, expected):
+    '''
+    Returns a message for each pool whose fired events differ from its schedule, or that fired late
+    '''
+    mismatches = []
+
+    for pool_id, expected_events in expected.items():
+        fired = [(fired_at, event) for fired_at, event in trace if event.pool_id == pool_id]
+
+        late = [(fired_at, event) for fired_at, event in fired if fired_at != event.event_time]
+        if late:
+            mismatches.append("Pool %d fired %d event(s) off their event time, first %s at %s" % (
+                pool_id, len(late), str(late[0][1]), late[0][0].isoformat()))
+
+        fired_dicts = [event.to_dict() for _, event in fired]
+        expected_dicts = [event.to_dict() for event in expected_events]
+        if fired_dicts == expected_dicts:
+            continue
+
+        index = next((i for i, (actual, wanted) in enumerate(zip(fired_dicts, expected_dicts)) if actual != wanted),
+                     min(len(fired_dicts), len(expected_dicts)))
+        mismatches.append("Pool %d fired %d event(s), expected %d, first difference at %d: %s != %s" % (
+            pool_id, len(fired_dicts), len(expected_dicts), index,
+            fired_dicts[index] if index < len(fired_dicts) else None,
+            expected_dicts[index] if index < len(expected_dicts) else None))
+
+    return mismatches
+
+
+def check_seasons(trace, seasons):
+    '''
+    Checks each start's duration against its program without going through the interpolation code
+    Peaks run the summer or winter duration, season starts halfway between them, every other day in between
+    '''
+    mismatches = []
+
+    for _, event in trace:
+        if event.EVENT != consts.START or event.pool_id not in seasons:
+            continue
+
+        pool_seasons, programs = seasons[event.pool_id]
+        program = programs[event.event_time.hour * 3600 + event.event_time.minute * 60 + event.event_time.second]
+        summer_seconds, winter_seconds = program.summer_duration, program.winter_duration
+        duration = event.duration.total_seconds()
+
+        summer, winter = pool_seasons[consts.SUMMER], pool_seasons[consts.WINTER]
+        month_day = (event.event_time.month, event.event_time.day)
+        expected = {
+            (summer.peak_month, summer.peak_day): summer_seconds,
+            (winter.peak_month, winter.peak_day): winter_seconds,
+            (summer.start_month, summer.start_day): (summer_seconds + winter_seconds) / 2,
+            (winter.start_month, winter.start_day): (summer_seconds + winter_seconds) / 2
+        }.get(month_day)
+
+        if expected is not None and abs(duration - expected) > DURATION_TOLERANCE_SECONDS:
+            mismatches.append("%s ran %.3f s, expected %.3f s on %d-%d" % (str(event), duration, expected, month_day[0], month_day[1]))
+        elif not min(summer_seconds, winter_seconds) - DURATION_TOLERANCE_SECONDS <= duration <= max(summer_seconds, winter_seconds) + DURATION_TOLERANCE_SECONDS:
+            mismatches.append("%s ran %.3f s, outside its winter and summer durations" % (str(event), duration))
+
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accelerated year-long scheduler simulation")
+    parser.add_argument("--database", default=os.path.join("database", "test_database.db"), help="Database to copy the pools, programs and seasons from")
+    parser.add_argument("--year", type=int, default=datetime.now().year)
+    parser.add_argument("--pools", type=int, nargs="+", help="Only trace and check these pools, every pool is still scheduled")
+    parser.add_argument("--output", help="Write the JSON lines trace here instead of stdout")
+    args = parser.parse_args()
+
+    start = datetime(args.year, 1, 1)
+    end = datetime(args.year + 1, 1, 1)
+
+    real_stdout = sys.stdout
+    with tempfile.TemporaryDirectory() as simulation_dir, open(os.devnull, "w") as devnull:
+        db_path = os.path.join(simulation_dir, "simulation.db")
+        copy_database(args.database, db_path)
+
+        wall_start = time.perf_counter()
+        # The scheduler logs every event, keep that out of the trace
+        with contextlib.redirect_stdout(devnull):
+            trace, expected, seasons = simulate(db_path, start, end, args.pools)
+        wall_seconds = time.perf_counter() - wall_start
+
+    lines = [json.dumps(dict(event.to_dict(), fired=fired_at.isoformat())) for fired_at, event in trace]
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write("\n".join(lines) + "\n")
+    else:
+        real_stdout.write("\n".join(lines) + "\n")
+
+    mismatches = compare(trace, expected) + check_seasons(trace, seasons)
+    for mismatch in mismatches:
+        print(mismatch, file=sys.stderr)
+
+    print("Simulated %s to %s: %d events for %d pool(s) in %.2f s, %d mismatch(es)" % (
+        start.date().isoformat(), end.date().isoformat(), len(trace), len(expected), wall_seconds, len(mismatches)), file=sys.stderr)
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import math
+import consts
+from clock import Clock
+from writebehind import WriteBehindBuffer
+
+MINUTE_SECONDS = 60
+HOUR_SECONDS = 3600
+# Bucket sizes samples are rolled up into as they are written
+ROLLUP_RESOLUTIONS = (MINUTE_SECONDS, HOUR_SECONDS)
+
+# Samples held in memory, the oldest are dropped if writes fall this far behind
+BUFFER_SIZE = 20000
+# Longest a sample waits in memory before it is written
+FLUSH_INTERVAL_SECONDS = 1.0
+# Buffered samples that trigger an early write
+FLUSH_BATCH_SIZE = 2000
+
+# Raw samples and minute buckets are pruned once older than these, hour buckets are kept
+SAMPLE_RETENTION_SECONDS = 86400
+MINUTE_RETENTION_SECONDS = 30 * 86400
+PRUNE_INTERVAL_SECONDS = 3600
+
+# Samples accepted per ingest request
+MAX_INGEST_SAMPLES = 5000
+# Points per metric a query returns by default, the step is widened to stay under it
+MAX_QUERY_POINTS = 1000
+MAX_RAW_SAMPLES = 10000
+
+
+def parse_samples(samples, now):
+    '''
+    Returns (timestamp, then each of consts.TELEMETRY_METRICS or None) per sample
+    samples - list of {time (unix seconds, defaults to now) and at least one metric as a number}
+    Raises ValueError for the first malformed sample
+    '''
+    if not isinstance(samples, list) or not all(isinstance(sample, dict) for sample in samples):
+        raise ValueError("Telemetry samples must be a list of objects")
+
+    if len(samples) > MAX_INGEST_SAMPLES:
+        raise ValueError("At most %d telemetry samples can be sent at once" % (MAX_INGEST_SAMPLES, ))
+
+    parsed = []
+    for index, sample in enumerate(samples):
+        unknown = set(sample) - set(consts.TELEMETRY_METRICS) - {consts.TIME}
+        if unknown:
+            raise ValueError("Sample %d has unknown fields %s" % (index, ", ".join(sorted(unknown))))
+
+        values = [sample.get(field) for field in (consts.TIME, ) + consts.TELEMETRY_METRICS]
+        if all(value is None for value in values[1:]):
+            raise ValueError("Sample %d has no metrics" % (index, ))
+
+        for value in values:
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value)):
+                raise ValueError("Sample %d values must be numbers" % (index, ))
+
+        if values[0] is None:
+            values[0] = now
+        parsed.append(tuple(values))
+
+    return parsed
+
+
+class Telemetry():
+    '''
+    Write-behind pump telemetry, ingesting only appends to a bounded buffer and never waits on SQLite
+    Buffered samples and their rollup deltas are written in one transaction, apart from the scheduler
+    Each worker buffers what it ingested, a query sees what other workers took in once they flushed
+    '''
+
+    def __init__(self, database, clock=None):
+        self.database = database
+        self.clock = clock if clock is not None else Clock()
+        self._pruned_at = 0
+
+        # (pool id, timestamp, then each of consts.TELEMETRY_METRICS) not yet written
+        self._samples = WriteBehindBuffer(self._write, "telemetry", FLUSH_INTERVAL_SECONDS, FLUSH_BATCH_SIZE,
+                                          max_size=BUFFER_SIZE, after_flush=self._prune_if_due)
+
+
+    def ingest(self, pool_id, samples):
+        '''
+        Buffers samples from parse_samples
+        '''
+        self._samples.add((pool_id, ) + sample for sample in samples)
+
+
+    def _write(self, samples):
+        self.database.append_telemetry(samples, get_rollups(samples))
+
+
+    def flush(self):
+        '''
+        Writes every sample buffered so far, a query flushes so it sees every sample ingested before it
+        '''
+        self._samples.flush()
+
+
+    def _prune_if_due(self):
+        if self.clock.time() - self._pruned_at >= PRUNE_INTERVAL_SECONDS:
+            self.prune()
+
+
+    def prune(self):
+        now = self.clock.time()
+        self.database.prune_telemetry(now - SAMPLE_RETENTION_SECONDS, {MINUTE_SECONDS: now - MINUTE_RETENTION_SECONDS})
+        self._pruned_at = now
+
+
+    def query(self, pool_id, first, last, metrics, step=None):
+        '''
+        Returns (step, {metric: [(point timestamp, count, mean, minimum, maximum)]}) from first through last (unix seconds)
+        step - seconds per point, rounded up to whole rollup buckets, by default the shortest giving at most MAX_QUERY_POINTS
+        Points are aligned to multiples of step, a point without samples is left out
+        '''
+        if step is None:
+            step = math.ceil((last - first) / MAX_QUERY_POINTS)
+
+        # Minute buckets while they are kept for the whole range, hour buckets past that
+        if step < HOUR_SECONDS and first >= self.clock.time() - MINUTE_RETENTION_SECONDS:
+            resolution = MINUTE_SECONDS
+        else:
+            resolution = HOUR_SECONDS
+        step = max(1, math.ceil(step / resolution)) * resolution
+
+        self.flush()
+        rows = self.database.get_telemetry_rollups(pool_id, resolution, metrics, first // resolution * resolution, last)
+
+        points = {metric: {} for metric in metrics}
+        for metric, bucket, count, total, minimum, maximum in rows:
+            point_time = bucket // step * step
+            point = points[metric].get(point_time)
+            if point is None:
+                points[metric][point_time] = [count, total, minimum, maximum]
+            else:
+                point[0] += count
+                point[1] += total
+                point[2] = min(point[2], minimum)
+                point[3] = max(point[3], maximum)
+
+        return step, {metric: [(point_time, count, total / count, minimum, maximum)
+                               for point_time, (count, total, minimum, maximum) in sorted(metric_points.items())]
+                      for metric, metric_points in points.items()}
+
+
+    def get_samples(self, pool_id, first, last):
+        '''
+        Returns (samples, truncated), the first MAX_RAW_SAMPLES raw samples from first through last as get_telemetry_samples
+        Samples are kept for SAMPLE_RETENTION_SECONDS
+        '''
+        self.flush()
+        samples = self.database.get_telemetry_samples(pool_id, first, last, MAX_RAW_SAMPLES + 1)
+        return samples[:MAX_RAW_SAMPLES], len(samples) > MAX_RAW_SAMPLES
+
+
+    def get_stats(self):
+        return self._samples.get_stats()
+
+
+def get_rollups(samples):
+    '''
+    Returns {(pool id, resolution, metric, bucket timestamp): [count, total, minimum, maximum]} of samples
+    for every resolution in ROLLUP_RESOLUTIONS
+    '''
+    rollups = {}
+
+    for sample in samples:
+        pool_id, timestamp = sample[0], sample[1]
+        for resolution in ROLLUP_RESOLUTIONS:
+            bucket = int(timestamp // resolution * resolution)
+            for metric, value in zip(consts.TELEMETRY_METRICS, sample[2:]):
+                if value is None:
+                    continue
+
+                key = (pool_id, resolution, metric, bucket)
+                totals = rollups.get(key)
+                if totals is None:
+                    rollups[key] = [1, value, value, value]
+                else:
+                    totals[0] += 1
+                    totals[1] += value
+                    if value < totals[2]:
+                        totals[2] = value
+                    if value > totals[3]:
+                        totals[3] = value
+
+    return rollups
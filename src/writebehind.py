@@ -0,0 +1,125 @@
+import collections
+import itertools
+import threading
+import time
+
+# Seconds the flusher waits after a failed write before trying again
+RETRY_SECONDS = 1.0
+
+
+class WriteBehindBuffer():
+    '''
+    Items are only added to an in-memory buffer, which never touches SQLite so it is safe under the scheduler lock
+    A flusher thread hands what was buffered to write() and retries it until it commits
+    keyed - items are (key, item) and only the latest item of a key is kept, otherwise they are written in order
+    max_size - buffered items past this drop the oldest, unbounded by default
+    '''
+
+    def __init__(self, write, description, interval=None, batch_size=1, max_size=None, keyed=False, after_flush=None):
+        '''
+        write - callable(items) committing a list of items, or a {key: item} dict when keyed
+        description - what is written, for the log
+        interval - longest an item waits before it is written, by default it is written as soon as the flusher is free
+        batch_size - buffered items that trigger a write before interval has passed
+        after_flush - callable() run by the flusher thread after each write it made
+        '''
+        self._write = write
+        self._description = description
+        self._interval = interval
+        self._batch_size = batch_size
+        self._max_size = max_size
+        self._keyed = keyed
+        self._after_flush = after_flush
+
+        self._condition = threading.Condition()
+        self._buffer = self._new_buffer()
+        self._dropped_count = 0
+        self._written_count = 0
+
+        # Serializes flushes so batches are written in the order they were buffered
+        self._flush_lock = threading.Lock()
+
+        self._flush_thread = threading.Thread(target=self._run, daemon=True)
+        self._flush_thread.start()
+
+
+    def _new_buffer(self):
+        return {} if self._keyed else collections.deque(maxlen=self._max_size)
+
+
+    def add(self, items):
+        '''
+        Buffers items, (key, item) pairs when keyed
+        '''
+        with self._condition:
+            if self._keyed:
+                self._buffer.update(items)
+            else:
+                items = list(items)
+                if self._max_size is not None:
+                    self._dropped_count += max(0, len(self._buffer) + len(items) - self._max_size)
+                self._buffer.extend(items)
+
+            if len(self._buffer) >= self._batch_size:
+                self._condition.notify()
+
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._buffer) >= self._batch_size, self._interval)
+
+            try:
+                self.flush()
+                if self._after_flush is not None:
+                    self._after_flush()
+            except Exception as e:
+                print("Failed to write %s, retrying: %s" % (self._description, str(e)))
+                time.sleep(RETRY_SECONDS)
+
+
+    def flush(self):
+        '''
+        Writes every item buffered so far, returns once it is committed
+        On failure the items go back to the front of the buffer, behind newer items of the same key when keyed
+        '''
+        with self._flush_lock:
+            with self._condition:
+                items = self._buffer
+                self._buffer = self._new_buffer()
+
+            if not items:
+                return
+
+            try:
+                self._write(items if self._keyed else list(items))
+            except Exception:
+                with self._condition:
+                    self._restore(items)
+                raise
+
+            with self._condition:
+                self._written_count += len(items)
+
+
+    def _restore(self, items):
+        '''
+        [REQUIRES CONDITION]
+        '''
+        if self._keyed:
+            for key, item in items.items():
+                self._buffer.setdefault(key, item)
+            return
+
+        restored = collections.deque(itertools.chain(items, self._buffer), maxlen=self._max_size)
+        self._dropped_count += len(items) + len(self._buffer) - len(restored)
+        self._buffer = restored
+
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                "buffered": len(self._buffer),
+                "written": self._written_count,
+                "dropped": self._dropped_count
+            }
@@ -0,0 +1,39 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+# Database reads the season defaults from database/ relative to the working directory
+os.chdir(REPO_ROOT)
+
+from clock import Clock
+from database import Database
+
+# Before the summer peak, so an overlap that only happens in summer is found this year
+TODAY = datetime(2026, 4, 1, 12, 0, 0)
+
+
+class FixedClock(Clock):
+    def __init__(self, now):
+        self._now = now
+
+    def now(self):
+        return self._now
+
+    def time(self):
+        return self._now.timestamp()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "test.db")
+
+
+@pytest.fixture
+def database(db_path):
+    database = Database("test", db_path, FixedClock(TODAY))
+    yield database
+    database.close()
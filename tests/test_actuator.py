@@ -0,0 +1,61 @@
+import threading
+import time
+
+from actuator import Actuator
+
+
+class HungController():
+    '''
+    Acknowledges every controller but hung_id, which never answers until released
+    '''
+
+    def __init__(self, hung_id):
+        self.hung_id = hung_id
+        self.released = threading.Event()
+        self.sent = []
+
+    def set_speed(self, speed, controller_id, timeout=None):
+        if controller_id == self.hung_id:
+            self.released.wait()
+        self.sent.append((controller_id, speed))
+        return True
+
+
+def wait_for(predicate, seconds=5):
+    deadline = time.monotonic() + seconds
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_hung_controller_does_not_hold_up_the_others():
+    backend = HungController(0)
+    actuator = Actuator(backend, timeout=0.1, attempts=2)
+
+    actuator.set_speed(1, 0)
+    actuator.set_speed(2, 1)
+
+    wait_for(lambda: (1, 2) in backend.sent)
+    # Both attempts time out in the actuator although the backend ignores the timeout
+    wait_for(lambda: actuator.get_stats()["failed"] == 1)
+    assert actuator.get_stats()["retries"] == 1
+
+    backend.released.set()
+    actuator.set_speed(3, 0)
+    wait_for(lambda: (0, 3) in backend.sent)
+
+
+def test_newer_command_replaces_one_not_sent_yet():
+    backend = HungController(0)
+    actuator = Actuator(backend, timeout=5)
+
+    # The first is being sent, the next two wait behind it and only the last is kept
+    actuator.set_speed(1, 0)
+    wait_for(lambda: actuator.get_stats()["queued"] == 0)
+    actuator.set_speed(2, 0)
+    actuator.set_speed(3, 0)
+    backend.released.set()
+
+    wait_for(lambda: actuator.get_stats()["sent"] == 2)
+    assert backend.sent == [(0, 1), (0, 3)]
+    assert actuator.get_stats()["coalesced"] == 1
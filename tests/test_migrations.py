@@ -0,0 +1,47 @@
+import os
+import shutil
+import sqlite3
+
+import consts
+import migrations
+from database import Database
+
+# The single pool database shipped before migrations existed, at user_version 0
+BASELINE_DATABASE = os.path.join("database", "test_database.db")
+
+
+def test_baseline_database_migrates_to_latest(tmp_path):
+    db_path = str(tmp_path / "baseline.db")
+    shutil.copyfile(BASELINE_DATABASE, db_path)
+
+    with sqlite3.connect(db_path) as conn:
+        assert migrations.get_version(conn) == 0
+
+    database = Database("test", db_path)
+    try:
+        with database._pool.connection() as conn:
+            assert migrations.get_version(conn) == migrations.LATEST_VERSION
+            tables = {row[0] for row in conn.execute('''SELECT name FROM sqlite_master WHERE type = 'table' ''')}
+
+        assert {"pools", "programs", "seasons", "runs", "scheduler_state", "data_version", "telemetry"} <= tables
+
+        # Its program moved to the default pool with times in seconds, "03:00:0" included
+        programs = database.get_all_programs(consts.DEFAULT_POOL_ID)
+        assert [(p.speed, p.start, p.summer_duration, p.winter_duration) for p in programs] == [(8, 85200, 10800, 3600)]
+
+        assert database.get_season_dates(consts.DEFAULT_POOL_ID) == {
+            consts.SUMMER: {consts.START: "3-20", consts.PEAK: "7-20"},
+            consts.WINTER: {consts.START: "9-15", consts.PEAK: "1-15"}
+        }
+    finally:
+        database.close()
+
+
+def test_current_database_is_not_migrated_again(tmp_path):
+    db_path = str(tmp_path / "baseline.db")
+    shutil.copyfile(BASELINE_DATABASE, db_path)
+    Database("test", db_path).close()
+
+    with sqlite3.connect(db_path) as conn:
+        assert migrations.is_current(conn)
+        assert migrations.migrate(conn, lambda conn, pool_id: None) == migrations.LATEST_VERSION
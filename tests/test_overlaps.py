@@ -0,0 +1,114 @@
+from datetime import datetime
+
+import pytest
+
+import consts
+from database import ProgramBatchError, ProgramOverlapError
+from models import Program
+
+POOL = consts.DEFAULT_POOL_ID
+HOUR = 3600
+
+
+def program(start, summer_duration, winter_duration=None):
+    return Program(None, POOL, 1, start, summer_duration, summer_duration if winter_duration is None else winter_duration)
+
+
+def test_overlapping_add_is_rejected(database):
+    existing = database.add_program(program(8 * HOUR, 2 * HOUR))
+
+    with pytest.raises(ProgramOverlapError) as error:
+        database.add_program(program(9 * HOUR, HOUR))
+
+    assert error.value.program.id == existing.id
+    assert [p.id for p in database.get_all_programs(POOL)] == [existing.id]
+
+
+def test_adjacent_programs_do_not_overlap(database):
+    database.add_program(program(8 * HOUR, HOUR))
+    database.add_program(program(9 * HOUR, HOUR))
+    # Ending where the other starts from the other side
+    database.add_program(program(7 * HOUR, HOUR))
+
+    assert len(database.get_all_programs(POOL)) == 3
+
+
+def test_run_past_midnight_overlaps_next_days_program(database):
+    database.add_program(program(23 * HOUR + 30 * 60, HOUR))
+
+    with pytest.raises(ProgramOverlapError):
+        database.add_program(program(15 * 60, HOUR))
+
+    # Starting as the late program ends, either way round
+    database.add_program(program(30 * 60, HOUR))
+    with pytest.raises(ProgramOverlapError):
+        database.add_program(program(22 * HOUR + 45 * 60, HOUR))
+
+
+def test_seasonal_overlap_is_found_on_the_day_it_happens(database):
+    # Runs three hours at the summer peak, one in winter, so it only reaches the 10:00 program part of the year
+    database.add_program(program(10 * HOUR, HOUR))
+
+    with pytest.raises(ProgramOverlapError) as error:
+        database.add_program(program(8 * HOUR, 3 * HOUR, HOUR))
+
+    overlap_date = error.value.overlap_date
+    duration = database.get_interpolated_duration(POOL, datetime(overlap_date.year, overlap_date.month, overlap_date.day),
+                                                  3 * HOUR, HOUR)
+    assert duration.total_seconds() > 2 * HOUR
+
+    # Never longer than the gap, it fits
+    database.add_program(program(7 * HOUR, 3 * HOUR, HOUR))
+
+
+def test_update_into_another_program_is_rejected(database):
+    first = database.add_program(program(8 * HOUR, HOUR))
+    second = database.add_program(program(10 * HOUR, HOUR))
+
+    with pytest.raises(ProgramOverlapError):
+        database.update_program(POOL, second.id, start=8 * HOUR + 30 * 60)
+    with pytest.raises(ProgramOverlapError):
+        database.update_program(POOL, first.id, summer_duration=3 * HOUR)
+
+    # A program never overlaps its own old version
+    database.update_program(POOL, first.id, start=8 * HOUR + 30 * 60)
+    assert [p.start for p in database.get_all_programs(POOL)] == [8 * HOUR + 30 * 60, 10 * HOUR]
+
+
+def test_adds_in_one_batch_are_checked_against_each_other(database):
+    with pytest.raises(ProgramBatchError) as error:
+        database.apply_program_batch(POOL, adds=[program(8 * HOUR, 2 * HOUR), program(9 * HOUR, HOUR)])
+
+    assert [(e[consts.ACTION], e[consts.INDEX]) for e in error.value.errors] == [(consts.ADD, 1)]
+    assert database.get_all_programs(POOL) == []
+
+
+def test_batch_can_replace_a_deleted_program(database):
+    existing = database.add_program(program(8 * HOUR, 2 * HOUR))
+
+    database.apply_program_batch(POOL, adds=[program(9 * HOUR, HOUR)], deletes=[existing.id])
+
+    assert [p.start for p in database.get_all_programs(POOL)] == [9 * HOUR]
+
+
+def test_batch_can_fill_the_slot_an_update_moves_away_from(database):
+    existing = database.add_program(program(8 * HOUR, 2 * HOUR))
+
+    database.apply_program_batch(POOL, adds=[program(9 * HOUR, HOUR)],
+                                 updates=[{consts.ID: existing.id, consts.START: 12 * HOUR}])
+
+    assert [p.start for p in database.get_all_programs(POOL)] == [9 * HOUR, 12 * HOUR]
+
+
+def test_rejected_batch_leaves_pending_programs_behind(database):
+    existing = database.add_program(program(8 * HOUR, 2 * HOUR))
+
+    with pytest.raises(ProgramBatchError):
+        database.apply_program_batch(POOL, adds=[program(9 * HOUR, HOUR), program(9 * HOUR + 30 * 60, HOUR)],
+                                     deletes=[existing.id])
+
+    # Neither the rolled back delete nor the rolled back adds are seen by the next check
+    assert [p.id for p in database.get_all_programs(POOL)] == [existing.id]
+    with pytest.raises(ProgramOverlapError):
+        database.add_program(program(9 * HOUR, HOUR))
+    database.add_program(program(11 * HOUR, HOUR))
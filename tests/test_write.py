@@ -0,0 +1,90 @@
+import pytest
+
+import consts
+from database import Database, ProgramBatchError
+from models import Program
+
+POOL = consts.DEFAULT_POOL_ID
+HOUR = 3600
+
+
+def program(start):
+    return Program(None, POOL, 1, start, HOUR, HOUR)
+
+
+def stored_starts(database):
+    with database._pool.connection() as conn:
+        return [row[0] for row in conn.execute('''SELECT start FROM programs ORDER BY start''')]
+
+
+def test_each_changing_write_bumps_the_version_once(database):
+    version = database.data_version
+
+    added = database.add_program(program(8 * HOUR))
+    assert database.data_version == version + 1
+
+    database.update_program(POOL, added.id, speed=2)
+    database.delete_program(POOL, added.id)
+    assert database.data_version == version + 3
+
+
+def test_writes_that_change_nothing_leave_the_version(database):
+    version = database.data_version
+
+    assert not database.delete_program(POOL, 999)
+    assert database.update_program(POOL, 999, speed=2) is None
+
+    assert database.data_version == version
+
+
+def test_batch_commits_with_one_version(database):
+    version = database.data_version
+
+    database.apply_program_batch(POOL, adds=[program(8 * HOUR), program(12 * HOUR)])
+
+    assert database.data_version == version + 1
+    assert [p.start for p in database.get_all_programs(POOL)] == [8 * HOUR, 12 * HOUR]
+
+
+def test_rolled_back_write_changes_neither_version_nor_caches(database):
+    existing = database.add_program(program(8 * HOUR))
+    version = database.data_version
+
+    with pytest.raises(ProgramBatchError):
+        database.apply_program_batch(POOL, adds=[program(12 * HOUR), program(8 * HOUR)], deletes=[999])
+
+    assert database.data_version == version
+    assert [p.id for p in database.get_all_programs(POOL)] == [existing.id]
+    assert stored_starts(database) == [8 * HOUR]
+
+
+def test_nested_write_that_rolls_back_is_discarded(database):
+    version = database.data_version
+
+    with database._write():
+        database.add_program(program(8 * HOUR))
+        with pytest.raises(RuntimeError):
+            with database._write():
+                database.add_program(program(12 * HOUR))
+                raise RuntimeError("rolled back")
+
+    assert database.data_version == version + 1
+    assert [p.start for p in database.get_all_programs(POOL)] == [8 * HOUR]
+    assert stored_starts(database) == [8 * HOUR]
+
+
+def test_caches_see_writes_of_another_process(database, db_path):
+    # Warm the caches before the other connection writes
+    assert database.get_all_programs(POOL) == []
+
+    other = Database("test", db_path)
+    try:
+        other.add_program(program(8 * HOUR))
+    finally:
+        other.close()
+
+    assert [p.start for p in database.get_all_programs(POOL)] == [8 * HOUR]
+
+    # And this process's next write is patched in on top of it
+    database.add_program(program(12 * HOUR))
+    assert [p.start for p in database.get_all_programs(POOL)] == [8 * HOUR, 12 * HOUR]